@@ -4,10 +4,14 @@ The main source code for GIP [short for Git In Python] :)
 """
 
 import argparse
+import bisect
 import collections
+import concurrent.futures
 import configparser
 from datetime import datetime
+import difflib
 import grp
+import mmap
 from os.path import exists
 import pwd
 from fnmatch import fnmatch
@@ -15,8 +19,14 @@ from math import ceil
 import os
 import sys
 import re
+import struct
+import tempfile
+import threading
 import zlib
 import hashlib
+import heapq
+import itertools
+import stat
 
 argparser = argparse.ArgumentParser(description="This is the parser for the arguments")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
@@ -28,16 +38,25 @@ commands = [
     "check-ignore",
     "checkout",
     "commit",
+    "commit-graph",
+    "diff-tree",
     "hash-object",
     "init",
     "log",
     "ls-files",
     "ls-tree",
+    "merge-base",
+    "pack-refs",
+    "repack",
+    "gc",
+    "rev-list",
     "rev-parse",
     "rm",
     "show-ref",
     "status",
     "tag",
+    "update-ref",
+    "write-tree",
 ]
 cmd_list = ", ".join(commands)
 
@@ -48,7 +67,15 @@ def main(argv=sys.argv[1:]):
     """
     if len(argv) < 1:
         return cmd_help()
+    # Like git, whatever follows "--" in log is a path, even if it looks
+    # like a ref; the other commands leave "--" to argparse.
+    paths = list()
+    if argv[0] == "log" and "--" in argv:
+        paths = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
     args = argparser.parse_args(argv)
+    if args.command == "log":
+        args.paths = paths
     match args.command:
         case "add":
             cmd_add(args)
@@ -60,6 +87,10 @@ def main(argv=sys.argv[1:]):
             cmd_checkout(args)
         case "commit":
             cmd_commit(args)
+        case "commit-graph":
+            cmd_commitgraph(args)
+        case "diff-tree":
+            cmd_difftree(args)
         case "hash-object":
             cmd_hashobject(args)
         case "init":
@@ -70,6 +101,16 @@ def main(argv=sys.argv[1:]):
             cmd_lsfiles(args)
         case "ls-tree":
             cmd_lstree(args)
+        case "merge-base":
+            cmd_mergebase(args)
+        case "pack-refs":
+            cmd_packrefs(args)
+        case "repack":
+            cmd_repack(args)
+        case "gc":
+            cmd_gc(args)
+        case "rev-list":
+            cmd_revlist(args)
         case "rev-parse":
             cmd_revparse(args)
         case "rm":
@@ -80,6 +121,10 @@ def main(argv=sys.argv[1:]):
             cmd_status(args)
         case "tag":
             cmd_tag(args)
+        case "update-ref":
+            cmd_updateref(args)
+        case "write-tree":
+            cmd_writetree(args)
         case "help":
             cmd_help()
         case _:
@@ -125,6 +170,9 @@ class GitRepo(object):
     """
 
     worktree, gitdir, conf = None, None, None
+    packs, cache, graph, loose, refs, bulk = None, None, None, None, None, None
+    bitmap, packs_mtime = None, None
+    fsync = frozenset()
 
     def __init__(self, path, force=False) -> None:
         self.worktree = path
@@ -148,6 +196,98 @@ class GitRepo(object):
                     "Unsupported repository format version: {}".format(vers)
                 )
 
+        self.cache = GitObjectCache(
+            repo_config_size(self, "core", "objectcachelimit", 64 * 1024 * 1024)
+        )
+        self.fsync = repo_config_fsync(self)
+
+
+class GitObjectCache(object):
+    """
+    A bounded LRU cache of parsed objects, sized by their raw length.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        with self.lock:
+            entry = self.entries.get(sha)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(sha)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, sha, obj, size):
+        if size > self.limit:
+            return
+        with self.lock:
+            if sha in self.entries:
+                self.size -= self.entries.pop(sha)[1]
+            self.entries[sha] = (obj, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= old
+
+
+def repo_config_size(repo, section, key, default):
+    """
+    to read a size from the config, with git's k, m and g suffixes.
+    """
+    value = repo.conf.get(section, key, fallback=None)
+    if value is None:
+        return default
+    value = value.strip().lower()
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+FSYNC_COMPONENTS = {
+    "loose-object": {"loose-object"},
+    "pack": {"pack"},
+    "pack-metadata": {"pack-metadata"},
+    "commit-graph": {"commit-graph"},
+    "index": {"index"},
+    "reference": {"reference"},
+    "objects": {"loose-object", "pack"},
+    "derived-metadata": {"pack-metadata", "commit-graph"},
+    "committed": {"loose-object", "pack", "reference"},
+    "added": {"loose-object", "pack", "reference", "index"},
+    "all": {"loose-object", "pack", "pack-metadata", "commit-graph", "index", "reference"},
+}
+
+
+def repo_config_fsync(repo):
+    """
+    to read which files core.fsync wants on disk before they are renamed
+    into place. Like git, it adds to (or with a "-", removes from) a
+    default of packs and their metadata; "none" starts from nothing.
+    """
+    default = {"pack", "pack-metadata", "commit-graph"}
+    if repo.conf.getboolean("core", "fsyncobjectfiles", fallback=False):
+        default.add("loose-object")
+
+    add, remove = set(), set()
+    for name in repo.conf.get("core", "fsync", fallback="").split(","):
+        name = name.strip().lower()
+        if name == "none":
+            default, add, remove = set(), set(), set()
+        elif name.startswith("-") and name[1:] in FSYNC_COMPONENTS:
+            remove |= FSYNC_COMPONENTS[name[1:]]
+        elif name in FSYNC_COMPONENTS:
+            add |= FSYNC_COMPONENTS[name]
+    return frozenset((default | add) - remove)
+
 
 def repo_path(repo, *path):
     """
@@ -177,7 +317,8 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception("{} is not a directory.".format(path))
 
     if mkdir:
-        os.makedirs(path)
+        # Another writer may be creating it at the same time.
+        os.makedirs(path, exist_ok=True)
         return path
     return None
 
@@ -264,13 +405,34 @@ def repo_find(path=".", required=True):
 
 
 argsp = argsubparsers.add_parser("cat-file", help="Display the content of a Git object")
+argsp.add_argument(
+    "-t", dest="show_type", action="store_true", help="Show the object type"
+)
+argsp.add_argument(
+    "-s", dest="show_size", action="store_true", help="Show the object size"
+)
+argsp.add_argument(
+    "-p", dest="pretty", action="store_true", help="Pretty-print the object"
+)
+argsp.add_argument(
+    "--batch",
+    dest="batch",
+    action="store_true",
+    help="Print the header and content of every object named on stdin",
+)
+argsp.add_argument(
+    "--batch-check",
+    dest="batch_check",
+    action="store_true",
+    help="Print the header of every object named on stdin",
+)
 argsp.add_argument(
     "type",
     metavar="type",
-    choices=["blob", "commit", "tag", "tree"],
-    help="Specify the type of object",
+    nargs="?",
+    help="Specify the type of object [blob, commit, tag, tree]",
 )
-argsp.add_argument("object", metavar="object", help="The object to display")
+argsp.add_argument("object", metavar="object", nargs="?", help="The object to display")
 
 
 def cmd_catfile(args):
@@ -278,24 +440,192 @@ def cmd_catfile(args):
     The main function of cat-file command.
     """
     repo = repo_find()
-    catfile(repo, args.object, fmt=args.type.encode())
+
+    if args.batch or args.batch_check:
+        catfile_batch(repo, contents=args.batch)
+        return
+
+    # With a single positional argument, it is the object.
+    if args.object is None:
+        args.object, args.type = args.type, None
+    if args.object is None:
+        raise Exception("cat-file needs an object")
+    if args.type and args.type not in ("blob", "commit", "tag", "tree"):
+        raise Exception("Unknown type: {}".format(args.type))
+    fmt = args.type.encode() if args.type else None
+
+    if args.show_type or args.show_size:
+        header = object_read_header(repo, object_find(repo, args.object, fmt=fmt))
+        if not header:
+            raise Exception("Object wasn't found")
+        print(header[0].decode("ascii") if args.show_type else header[1])
+    elif args.pretty or fmt:
+        catfile(repo, args.object, fmt=fmt, pretty=args.pretty)
+    else:
+        raise Exception("cat-file needs a type or one of -t, -s and -p")
 
 
-def catfile(repo, obj, fmt=None):
+def catfile(repo, obj, fmt=None, pretty=False):
     """
-    This function prints all content to stdout.
+    This function streams all content to stdout.
     """
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    if not obj:
+    sha = object_find(repo, obj, fmt=fmt)
+    stream = object_stream(repo, sha)
+    if not stream:
         raise Exception("Object wasn't found")
-    sys.stdout.buffer.write(obj.serialize())
+
+    kind, size, chunks = stream
+    if fmt and kind != fmt:
+        raise Exception("{} is a {}, not a {}".format(obj, kind.decode(), fmt.decode()))
+
+    if pretty and kind == b"tree":
+        chunks.close()
+        ls_tree(repo, sha)
+        return
+
+    out = sys.stdout.buffer
+    for chunk in chunks:
+        out.write(chunk)
+
+
+def catfile_batch(repo, contents=True, inp=None, out=None):
+    """
+    to answer a stream of object names, one per line, in a single process.
+    Every answer is "<sha> <type> <size>", followed by the content and a
+    newline with contents, or "<name> missing"; output is flushed after
+    each answer so the caller can interleave its requests.
+    """
+    inp = inp or sys.stdin.buffer
+    out = out or sys.stdout.buffer
+
+    for line in inp:
+        name = line.rstrip(b"\r\n").decode("utf8")
+        try:
+            sha = object_find(repo, name)
+            stream = object_stream(repo, sha) if contents else None
+            header = stream[0:2] if contents else object_read_header(repo, sha)
+        except Exception:
+            stream = header = None
+
+        if not header:
+            out.write(name.encode("utf8") + b" missing\n")
+            out.flush()
+            continue
+
+        out.write(b"%s %s %d\n" % (sha.encode("ascii"), header[0], header[1]))
+        if stream:
+            for chunk in stream[2]:
+                out.write(chunk)
+            out.write(b"\n")
+        out.flush()
 
 
 def object_find(repo, name, fmt=None, follow=True):
     """
-    This will only print name for now.
+    to resolve name (a full or abbreviated sha, HEAD, or a ref) to a sha.
+    With fmt, tags are peeled, and commits give their tree, until an
+    object of that type is reached.
+    """
+    sha = object_resolve(repo, name)
+    if not sha:
+        raise Exception("No such reference {}.".format(name))
+
+    while fmt:
+        header = object_read_header(repo, sha)
+        if not header:
+            raise Exception("Object {} is missing".format(sha))
+        if header[0] == fmt:
+            break
+        if not follow:
+            raise Exception("{} is a {}, not a {}".format(name, header[0].decode(), fmt.decode()))
+        if header[0] == b"tag":
+            sha = object_read(repo, sha).kvlm[b"object"].decode("ascii")
+        elif header[0] == b"commit" and fmt == b"tree":
+            sha = object_read(repo, sha).tree
+        else:
+            raise Exception("{} is a {}, not a {}".format(name, header[0].decode(), fmt.decode()))
+    return sha
+
+
+HEX_SHA = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
+
+def object_resolve(repo, name):
+    """
+    to find the sha name stands for, or None.
+    Like git, a full sha wins, then refs, then unique abbreviations.
+    """
+    if not name.strip():
+        return None
+    if name == "HEAD":
+        return ref_resolve(repo, "HEAD")
+    if len(name) == 40 and HEX_SHA.match(name):
+        return name.lower()
+
+    for ref in (
+        name,
+        "refs/" + name,
+        "refs/tags/" + name,
+        "refs/heads/" + name,
+        "refs/remotes/" + name,
+        "refs/remotes/" + name + "/HEAD",
+    ):
+        if ref == "HEAD" or ref.startswith("refs/"):
+            sha = ref_resolve(repo, ref)
+            if sha:
+                return sha
+
+    if HEX_SHA.match(name):
+        matches = object_prefix_lookup(repo, name.lower(), limit=2)
+        if len(matches) > 1:
+            raise Exception("Short sha {} is ambiguous.".format(name))
+        if matches:
+            return matches[0]
+    return None
+
+
+def object_prefix_lookup(repo, prefix, limit=None):
+    """
+    to list the objects whose sha starts with prefix, at most limit.
+    Loose objects come from a sorted listing of their fan-out directory,
+    cached until the directory changes; packs are binary searched.
+    """
+    matches = set()
+
+    listing = loose_listing(repo, prefix[0:2])
+    i = bisect.bisect_left(listing, prefix)
+    while i < len(listing) and listing[i].startswith(prefix):
+        matches.add(listing[i])
+        i += 1
+
+    for pack in repo_packs(repo):
+        matches.update(pack.find_prefix(prefix, limit))
+    if not matches and repo_packs_reload(repo):
+        return object_prefix_lookup(repo, prefix, limit)
+
+    return sorted(matches)[:limit]
+
+
+def loose_listing(repo, fanout):
+    """
+    the sorted shas of the loose objects of one fan-out directory.
     """
-    return name
+    if repo.loose is None:
+        repo.loose = dict()
+    path = repo_path(repo, "objects", fanout)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    cached = repo.loose.get(fanout)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    listing = sorted(
+        fanout + f for f in os.listdir(path) if len(f) == 38 and not f.startswith("tmp")
+    )
+    repo.loose[fanout] = (mtime, listing)
+    return listing
 
 
 class GitObject(object):
@@ -322,14 +652,44 @@ class GitObject(object):
 def object_read(repo, sha):
     """
     to read the object's sha from git repo.
+    Parsed objects are kept in the repository's cache, so callers must
+    not modify what they get back.
     """
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    obj = repo.cache.get(sha)
+    if obj is not None:
+        return obj
+
+    raw = object_read_raw(repo, sha)
 
-    if not os.path.isfile(path):
+    if not raw:
         return None
 
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    fmt, data = raw
+
+    # Pick constructor
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+    # Call constructor, cache and return object
+    obj = c(data)
+    repo.cache.put(sha, obj, len(data))
+    return obj
+
+
+def object_read_raw(repo, sha):
+    """
+    to read the type and the content of an object, loose or packed.
+    """
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+
+    if path and os.path.isfile(path):
+        with open (path, "rb") as f:
+            raw = zlib.decompress(f.read())
 
         # Read object type
         x = raw.find(b' ')
@@ -341,304 +701,2245 @@ def object_read(repo, sha):
         if size != len(raw)-y-1:
             raise Exception("Malformed object {0}: bad length".format(sha))
 
-        # Pick constructor
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+        return fmt, raw[y+1:]
 
-        # Call constructor and return object
-        return c(raw[y+1:])
+    return pack_read_object(repo, sha)
 
 
-def object_write(obj, repo=None):
-    """
-    function to write object's hash representation.
-    """
-    data = obj.serialize()
-    result = obj.fmt + b" " + str(len(data)).encode() + b"\x00" + data
 
-    sha = hashlib.sha1(result).hexdigest()
-    if repo:
-        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
 
-        if not path:
-            raise Exception("path not found.")
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                f.write(zlib.compress(result))
-    return sha
+OBJECT_CHUNK = 64 * 1024
+OBJECT_HEADER_CHUNK = 256
 
 
-class GitBlob(GitObject):
+def object_read_header(repo, sha):
     """
-    This defines a GitBlob object.
+    to read only the type and the size of an object.
+    Just enough of the object is inflated to reach its header.
     """
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-    fmt = b"blob"
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            pieces = object_inflate(lambda: f.read(OBJECT_HEADER_CHUNK), OBJECT_HEADER_CHUNK)
+            fmt, size, rest = object_split_header(sha, pieces)
+            pieces.close()
+            return fmt, size
 
-    def serialize(self):
-        return self.blobdata
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    return pack_read_header(repo, *found)
 
-    def deserialize(self, data):
-        self.blobdata = data
 
+def object_stream(repo, sha, chunk=OBJECT_CHUNK):
+    """
+    to read an object as (fmt, size, chunks) where chunks is an iterator
+    over its content, so big blobs are never held in memory at once.
+    """
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-argsp = argsubparsers.add_parser("hash-object", help="Compute object id and sha")
+    if path and os.path.isfile(path):
+        f = open(path, "rb")
+        pieces = object_inflate(lambda: f.read(chunk), chunk)
+        fmt, size, rest = object_split_header(sha, pieces)
+        return fmt, size, object_stream_body(sha, f, size, rest, pieces)
 
-argsp.add_argument(
-    "-t",
-    metavar="type",
-    dest="type",
-    choices=["blob", "commit", "tag", "tree"],
-    default="blob",
-    help="Specify the type of object",
-)
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    pack, offset = found
 
-argsp.add_argument(
-    "-w", dest="write", action="store_true", help="write Object to database"
-)
+    kind, size, base, pos = pack.entry_header(offset)
+    if kind in PACK_TYPES:
+        return PACK_TYPES[kind], size, pack.inflate_stream(pos, chunk)
 
-argsp.add_argument("path", help="Read object from <file>")
+    # Deltas can only be applied on the whole base.
+    fmt, data = pack_read(repo, pack, offset)
+    chunks = (data[i : i + chunk] for i in range(0, len(data), chunk))
+    return fmt, len(data), chunks
 
 
-def cmd_hashobject(args):
+def object_inflate(read, chunk):
     """
-    The base kickstarter for hash-object
+    to inflate a zlib stream in pieces of at most chunk bytes.
     """
-    if args.write:
-        repo = repo_find()
-    else:
-        repo = None
-
-    with open(args.path, "rb") as f:
-        sha = object_hash(f, args.type.encode(), repo)
-        print(sha)
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail or read()
+        if not data:
+            raise Exception("Truncated object stream")
+        out = d.decompress(data, chunk)
+        if out:
+            yield out
 
 
-def object_hash(f, fmt, repo=None):
+def object_split_header(sha, pieces):
     """
-    to hash an object, to write it to repository if needed
+    to read the "fmt size\x00" header from the first inflated pieces.
     """
-    data = f.read()
+    head = b""
+    for piece in pieces:
+        head += piece
+        if b"\x00" in head:
+            break
 
-    match fmt:
-        case b"commit":
-            obj = GitCommit(data)
-        case b"tree":
-            obj = GitTree(data)
-        case b"tag":
-            obj = GitTag(data)
-        case b"blob":
-            obj = GitBlob(data)
-        case _:
-            raise Exception("Unknown type: {}".format(fmt))
-    return object_write(obj, repo)
+    x = head.find(b" ")
+    y = head.find(b"\x00", x)
+    if x < 0 or y < 0:
+        raise Exception("Malformed object {0}: bad header".format(sha))
+    return head[0:x], int(head[x:y].decode("ascii")), head[y + 1 :]
 
 
-def kvlmParse(raw, start=0, dct=None):
+def object_stream_body(sha, f, size, rest, pieces):
     """
-    Key-Value List with Messages.
-    This function will help with parsing the commit fields.
+    to yield the remaining content of a loose object and close its file.
     """
+    seen = 0
+    try:
+        if rest:
+            seen += len(rest)
+            yield rest
+        for piece in pieces:
+            seen += len(piece)
+            yield piece
+    finally:
+        f.close()
+    if seen != size:
+        raise Exception("Malformed object {0}: bad length".format(sha))
 
-    if not dct:
-        dct = collections.OrderedDict()
-    
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    if (spc < 0) or (nl < spc):
-        assert nl == start
-        dct[None] = raw[start+1:]
-        return dct
-    
-    key = raw[start:spc]
-
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
 
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
+def object_write(obj, repo=None):
+    """
+    function to write object's hash representation.
+    """
+    data = obj.serialize()
+    if repo and repo.bulk:
+        return repo.bulk.write(obj.fmt, len(data), (data,))
+    header = obj.fmt + b" " + str(len(data)).encode() + b"\x00"
 
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [ dct[key], value ]
-    else:
-        dct[key]=value
+    h = hashlib.sha1(header)
+    h.update(data)
+    sha = h.hexdigest()
+    if repo:
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
 
-    return kvlmParse(raw, start=end+1, dct=dct)
+        if not path:
+            raise Exception("path not found.")
+        if not (os.path.exists(path) or pack_find(repo, sha)):
+            tmp = object_write_temp(repo, (header, data), os.path.dirname(path))
+            object_write_rename(tmp, path)
+    return sha
 
 
-def kvlmSerialize(kvlm):
+def object_write_stream(fmt, size, chunks, repo=None):
     """
-    to write similar objects like the above function.
+    to hash, and write if repo is given, an object of a known size whose
+    content comes in chunks; memory use does not depend on the size.
     """
+    if repo and repo.bulk:
+        return repo.bulk.write(fmt, size, chunks)
+    header = fmt + b" " + str(size).encode() + b"\x00"
+    h = hashlib.sha1(header)
+    seen = 0
+
+    def hashed():
+        nonlocal seen
+        for chunk in chunks:
+            h.update(chunk)
+            seen += len(chunk)
+            yield chunk
 
-    rtn = b""
-
-    for k in kvlm.keys():
-        if k is None:
-            continue
-        value = kvlm[k]
-        if not isinstance(value, list):
-            value = [value]
-        for v in value:
-            rtn += k + b" " + v.replace(b"\n", b"\n ") + b"\n"
-
-    rtn += b"\n" + kvlm[None] + b"\n"
-
-    return rtn
+    if repo:
+        # The sha, so the fan-out directory, is only known at the end.
+        tmp = object_write_temp(
+            repo, itertools.chain((header,), hashed()), repo_dir(repo, "objects")
+        )
+    else:
+        tmp = None
+        for _ in hashed():
+            pass
+
+    if seen != size:
+        if tmp:
+            os.remove(tmp)
+        raise Exception("Size changed while hashing: {} != {}".format(seen, size))
+
+    sha = h.hexdigest()
+    if tmp and pack_find(repo, sha):
+        os.remove(tmp)
+    elif tmp:
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+        object_write_rename(tmp, path)
+    return sha
 
 
-class GitCommit(GitObject):
+def object_write_temp(repo, chunks, path):
     """
-    this defines the class git commit and creates its objects.
+    to compress chunks into a uniquely named temporary file of the
+    directory path, read-only like objects and flushed to disk if
+    core.fsync asks for loose objects.
     """
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=path)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            z = zlib.compressobj()
+            for chunk in chunks:
+                f.write(z.compress(chunk))
+            f.write(z.flush())
+            os.fchmod(f.fileno(), 0o444)
+            if "loose-object" in repo.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp
+
+
+def object_write_rename(tmp, path):
+    """
+    to move a temporary object into place, unless it already exists.
+    Objects are named by their content, so when two writers race the
+    rename is atomic and either copy is right.
+    """
+    if os.path.exists(path):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, path)
 
-    fmt = b"commit"
-
-    def deserialize(self, data):
-        self.kvlm = kvlmParse(data)
 
-    def serialize(self):
-        return kvlmSerialize(self.kvlm)
+PACK_TYPES = {1: b"commit", 2: b"tree", 3: b"blob", 4: b"tag"}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
 
-    def init(self):
-        self.kvlm = dict()
 
+class GitPack(object):
+    """
+    This defines a packfile with its memory-mapped version 2 .idx file.
+    """
 
-argsp = argsubparsers.add_parser("log", help="Display history of a commit.")
-argsp.add_argument("commit", default="HEAD", nargs="?", help="commit to start at")
+    def __init__(self, path):
+        self.idxpath = path
+        self.packpath = path[:-4] + ".pack"
+
+        with open(self.idxpath, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.idx[0:8] != b"\377tOc\x00\x00\x00\x02":
+            raise Exception("Unsupported pack index {}".format(path))
+
+        with open(self.packpath, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.pack[0:4] != b"PACK":
+            raise Exception("Malformed pack {}".format(self.packpath))
+
+        # The fanout table holds, for every first byte, the number of
+        # objects whose sha starts with a byte lower or equal to it.
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_table = self.offset_table + 4 * self.count
+
+    def sha(self, i):
+        """
+        the raw sha of the i-th object of the index.
+        """
+        pos = self.sha_table + 20 * i
+        return self.idx[pos : pos + 20]
+
+    def offset(self, i):
+        """
+        the pack offset of the i-th object of the index.
+        """
+        (off,) = struct.unpack_from(">I", self.idx, self.offset_table + 4 * i)
+        if off & 0x80000000:
+            pos = self.large_table + 8 * (off & 0x7FFFFFFF)
+            (off,) = struct.unpack_from(">Q", self.idx, pos)
+        return off
+
+    def find(self, binsha):
+        """
+        the position of binsha in the index, or None.
+        """
+        return fanout_find(self.idx, self.fanout, self.sha_table, binsha)
+
+    def find_prefix(self, prefix, limit=None):
+        """
+        the hex shas of the index starting with prefix, at most limit.
+        """
+        binsha = bytes.fromhex((prefix + "0" * 40)[:40])
+        i = fanout_lower_bound(self.idx, self.fanout, self.sha_table, binsha)
+        matches = list()
+        while i < self.count and (limit is None or len(matches) < limit):
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            matches.append(sha)
+            i += 1
+        return matches
+
+    def entry_header(self, offset):
+        """
+        to read the type, the size and the delta base of a pack entry.
+        """
+        pack = self.pack
+        c = pack[offset]
+        pos = offset + 1
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = pack[pos]
+            pos += 1
+            size |= (c & 0x7F) << shift
+            shift += 7
+
+        base = None
+        if kind == PACK_OFS_DELTA:
+            c = pack[pos]
+            pos += 1
+            rel = c & 0x7F
+            while c & 0x80:
+                c = pack[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7F)
+            base = offset - rel
+        elif kind == PACK_REF_DELTA:
+            base = pack[pos : pos + 20].hex()
+            pos += 20
+
+        return kind, size, base, pos
+
+    def inflate_stream(self, pos, chunk):
+        """
+        to inflate the zlib stream starting at pos, chunk bytes at a time.
+        """
+
+        def read():
+            nonlocal pos
+            data = self.pack[pos : pos + chunk]
+            pos += len(data)
+            return data
+
+        return object_inflate(read, chunk)
+
+    def inflate(self, pos, size):
+        """
+        to inflate the zlib stream starting at pos.
+        """
+        d = zlib.decompressobj()
+        out = []
+        step = max(size, 4096)
+        while not d.eof:
+            chunk = self.pack[pos : pos + step]
+            if not chunk:
+                raise Exception("Truncated pack {}".format(self.packpath))
+            out.append(d.decompress(chunk))
+            pos += len(chunk)
+        data = b"".join(out)
+        if len(data) != size:
+            raise Exception("Malformed pack entry in {}".format(self.packpath))
+        return data
 
 
-def cmd_log(args):
+def fanout_find(buf, fanout, table, binsha):
     """
-    kickstarter for log command.
+    binary search a sorted table of raw shas between the fanout bounds of
+    the first byte of binsha.
     """
-    repo = repo_find()
-    print("base giplog:\t")
-    log_graphiz(repo, object_find(repo, args.commit), set())
-    print()
+    i = fanout_lower_bound(buf, fanout, table, binsha)
+    pos = table + 20 * i
+    if i < fanout[binsha[0]] and buf[pos : pos + 20] == binsha:
+        return i
+    return None
 
 
-def log_graphiz(repo, sha, seen):
+def fanout_lower_bound(buf, fanout, table, binsha):
     """
-    We will use graphiz software to show log in a graphical representation.
+    the position of the first sha of the table not lower than binsha.
     """
-    if sha in seen:
-        return
-    seen.add(sha)
-    commit = object_read(repo, sha)
-    if not commit or commit.fmt != b"commit":
-        raise Exception("The object is not a commit object")
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace('"', '\\"')
+    first = binsha[0]
+    lo = fanout[first - 1] if first else 0
+    hi = fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = table + 20 * mid
+        if buf[pos : pos + 20] < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
-    if "\n" in message:
-        message = message[: message.index("\n")]
 
-    print('\tc_{} [label="{}: {}"]'.format(sha, sha[0:7], message))
-    assert commit.fmt == b"commit"
+def repo_packs(repo):
+    """
+    to load, once, the packs found in objects/pack.
+    """
+    if repo.packs is None:
+        repo_packs_load(repo, dict())
+    return repo.packs
 
-    if b"parent" not in commit.kvlm.keys():
-        return
 
-    parents = commit.kvlm[b"parent"]
+def repo_packs_load(repo, opened):
+    """
+    to list the packs of objects/pack, reusing the opened ones by path.
+    """
+    repo.packs = list()
+    repo.packs_mtime = repo_packs_mtime(repo)
+    path = repo_dir(repo, "objects", "pack")
+    if path:
+        for f in sorted(os.listdir(path)):
+            idx = os.path.join(path, f)
+            if f.endswith(".idx") and os.path.exists(idx[:-4] + ".pack"):
+                repo.packs.append(opened.get(idx) or GitPack(idx))
+
+
+def repo_packs_mtime(repo):
+    try:
+        return os.stat(repo_path(repo, "objects", "pack")).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-    if not isinstance(parents, list):
-        parents = [parents]
 
-    for p in parents:
-        if not p:
-            raise Exception("parent not found.")
-        p = p.decode("ascii")
-        print("\tc_{} -> c_{}".format(sha, p))
-        print("\n\t", "-" * 100, "\n")
-        log_graphiz(repo, p, seen)
+def repo_packs_reload(repo):
+    """
+    to pick up the packs another process added or removed since they
+    were loaded, like git re-preparing its packs when an object seems to
+    be missing. Packs still there stay open. Returns whether anything
+    may have changed.
+    """
+    if repo.packs is None or repo_packs_mtime(repo) == repo.packs_mtime:
+        return False
+    repo_packs_load(repo, {pack.idxpath: pack for pack in repo.packs})
+    repo.bitmap = None
+    return True
 
 
-argsp = argsubparsers.add_parser("ls-tree", help="print a tree object")
-argsp.add_argument(
-    "-r", dest="recursive", action="store_true", help="recursive into trees"
-)
-argsp.add_argument("tree", help="a tree-like object")
+def pack_find(repo, sha):
+    """
+    to find which pack holds sha, and at which offset. When it is in none
+    of them, the packs are reloaded once in case a repack moved it.
+    """
+    binsha = bytes.fromhex(sha)
+    for retry in (False, True):
+        if retry and not repo_packs_reload(repo):
+            break
+        for pack in repo_packs(repo):
+            i = pack.find(binsha)
+            if i is not None:
+                return pack, pack.offset(i)
+    return None
 
 
-def cmd_lstree(args):
+def pack_read_object(repo, sha):
     """
-    kickstarter for ls-tree command.
+    to find an object in the packs and read its type and content.
     """
-    repo = repo_find()
-    ls_tree(repo, args.tree, args.recursive)
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    return pack_read(repo, *found)
 
 
-def ls_tree(repo, ref, recursive=None, prefix=""):
-    sha = object_find(repo, ref, fmt=b"tree")
-    obj = object_read(repo, sha)
-    for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
+def pack_read_header(repo, pack, offset):
+    """
+    to read the type and size of a pack entry without resolving it.
+    A delta holds the size of its result in its first bytes, and the type
+    is the one of the end of its chain.
+    """
+    kind, size, base, pos = pack.entry_header(offset)
+    if kind in PACK_TYPES:
+        return PACK_TYPES[kind], size
+
+    # The two sizes take at most 20 bytes.
+    head = b""
+    for piece in pack.inflate_stream(pos, 32):
+        head += piece
+        if len(head) >= 20:
+            break
+    _, n = delta_varint(head, 0)
+    size, _ = delta_varint(head, n)
+
+    while kind == PACK_OFS_DELTA:
+        kind, _, base, _ = pack.entry_header(base)
+    if kind == PACK_REF_DELTA:
+        header = object_read_header(repo, base)
+        if not header:
+            raise Exception("Missing delta base {}".format(base))
+        return header[0], size
+    return PACK_TYPES[kind], size
+
+
+def pack_read(repo, pack, offset):
+    """
+    to read the entry at offset, resolving the whole delta chain.
+    """
+    deltas = list()
+    while True:
+        kind, size, base, pos = pack.entry_header(offset)
+        if kind == PACK_OFS_DELTA:
+            deltas.append(pack.inflate(pos, size))
+            offset = base
+        elif kind == PACK_REF_DELTA:
+            deltas.append(pack.inflate(pos, size))
+            raw = object_read_raw(repo, base)
+            if not raw:
+                raise Exception("Missing delta base {}".format(base))
+            fmt, data = raw
+            break
+        elif kind in PACK_TYPES:
+            fmt, data = PACK_TYPES[kind], pack.inflate(pos, size)
+            break
         else:
-            type = item.mode[0:2]
+            raise Exception("Unknown pack entry type {}".format(kind))
 
-        match type: # Determine the type.
-            case b'04': type = "tree"
-            case b'10': type = "blob" # A regular file.
-            case b'12': type = "blob" # A symlink. Blob contents is link target.
-            case b'16': type = "commit" # A submodule
-            case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
-
-        if not (recursive and type=='tree'): # This is a leaf
-            print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-                # Git's ls-tree displays the type
-                # of the object pointed to.  We can do that too :)
-                type,
-                item.sha,
-                os.path.join(prefix, item.path)))
-        else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+    for delta in reversed(deltas):
+        data = delta_apply(data, delta)
+    return fmt, data
 
 
-class GitTreeLeaf(object):
+def delta_varint(delta, pos):
     """
-    This defines a git tree leaf object.
+    to read the little-endian sizes at the start of a delta.
     """
-
-    def __init__(self, mode, path, sha):
-        self.mode = mode
-        self.path = path
-        self.sha = sha
+    value = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        value |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
 
 
-def tree_parse_one(content, start=0):
+def delta_apply(base, delta):
     """
-    this parser is made to extract a single record.
+    to rebuild an object from its base and a git delta.
     """
-    x = content.find(b" ", start)
-    assert x - start == 5 or x - start == 6
-    mode = content[start:x]
-    if len(mode) == 5:
-        mode = b" " + mode
+    src_size, pos = delta_varint(delta, 0)
+    dst_size, pos = delta_varint(delta, pos)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy a range of the base.
+            off = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    off |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[off : off + size]
+        elif op:
+            # Insert new data.
+            out += delta[pos : pos + op]
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode")
 
-    y = content.find(b"\x00", x)
-    path = content[x + 1 : y]
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch")
+    return bytes(out)
 
-    sha = format(int.from_bytes(content[y + 1, y + 21], "big"), "040x")
-    return (y + 21, GitTreeLeaf(mode, path.decode("utf8"), sha))
 
+DELTA_BLOCK = 16
 
-def tree_parse(content):
+
+def delta_create(base, target, index=None):
     """
-    this will recall the above function recursively.
+    to encode target as a git delta against base.
+    index is the block index of base, built by delta_index when None.
+    """
+    if index is None:
+        index = delta_index(base)
+
+    out = bytearray()
+    out += delta_size(len(base))
+    out += delta_size(len(target))
+
+    pos = 0
+    insert = 0
+    end = len(target)
+    base_end = len(base)
+    while pos + DELTA_BLOCK <= end:
+        off = index.get(target[pos : pos + DELTA_BLOCK])
+        if off is None:
+            pos += 1
+            continue
+
+        # Extend the match forward, then back over pending literals.
+        size = DELTA_BLOCK
+        while (
+            pos + size < end
+            and off + size < base_end
+            and target[pos + size] == base[off + size]
+        ):
+            size += 1
+        while pos > insert and off > 0 and target[pos - 1] == base[off - 1]:
+            pos -= 1
+            off -= 1
+            size += 1
+
+        delta_insert(out, target, insert, pos)
+        delta_copy(out, off, size)
+        pos += size
+        insert = pos
+
+    delta_insert(out, target, insert, end)
+    return bytes(out)
+
+
+def delta_index(base):
+    """
+    to map every aligned block of base to its offset.
+    """
+    index = dict()
+    for off in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[off : off + DELTA_BLOCK], off)
+    return index
+
+
+def delta_size(size):
+    """
+    to encode the little-endian sizes at the start of a delta.
+    """
+    out = bytearray()
+    while True:
+        c = size & 0x7F
+        size >>= 7
+        if size:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return out
+
+
+def delta_insert(out, data, start, end):
+    """
+    to append insert opcodes for data[start:end], 127 bytes at most each.
+    """
+    while start < end:
+        n = min(end - start, 0x7F)
+        out.append(n)
+        out += data[start : start + n]
+        start += n
+
+
+def delta_copy(out, off, size):
+    """
+    to append copy opcodes, 64 KiB at most each.
+    """
+    while size:
+        n = min(size, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (off >> (8 * i)) & 0xFF
+            if byte:
+                op |= 1 << i
+                args.append(byte)
+        if n != 0x10000:
+            for i in range(3):
+                byte = (n >> (8 * i)) & 0xFF
+                if byte:
+                    op |= 0x10 << i
+                    args.append(byte)
+        out.append(op)
+        out += args
+        off += n
+        size -= n
+
+
+def pack_name_hash(name):
+    """
+    git's path hint: a hash that mostly depends on the last characters,
+    so that files with the same name or extension sort together.
+    """
+    h = 0
+    for c in name:
+        if c in b" \t\n\r\v\f":
+            continue
+        h = ((h >> 2) + (c << 24)) & 0xFFFFFFFF
+    return h
+
+
+def pack_entry_header(kind, size):
+    """
+    to encode the type and size header of a pack entry.
+    """
+    c = (kind << 4) | (size & 15)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7F
+        size >>= 7
+    out.append(c)
+    return out
+
+
+def pack_ofs_encode(rel):
+    """
+    to encode the distance to an OFS_DELTA base.
+    """
+    out = bytearray([rel & 0x7F])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        out.append(0x80 | (rel & 0x7F))
+        rel >>= 7
+    out.reverse()
+    return out
+
+
+def pack_write(repo, objects, window=10, depth=50):
+    """
+    to write objects, a list of (sha, fmt, size, name), as one pack.
+    Returns the path of the new .idx.
+    """
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp = os.path.join(path, "tmp_pack_{}".format(os.getpid()))
+
+    try:
+        with open(tmp, "wb") as f:
+            trailer, entries = pack_write_entries(repo, f, objects, window, depth)
+            if "pack" in repo.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    name = os.path.join(path, "pack-{}".format(trailer.hex()))
+    os.replace(tmp, name + ".pack")
+    pack_write_index(name + ".idx", entries, trailer, "pack-metadata" in repo.fsync)
+    return name + ".idx"
+
+
+def pack_write_entries(repo, f, objects, window, depth):
+    """
+    to write the pack stream of objects to f.
+    Objects are sorted by type, path hint and decreasing size, and a window
+    of the previous objects of the same type is searched for the smallest
+    delta; bases always come first so OFS_DELTA can be used.
+    Returns the pack checksum and the (binsha, crc32, offset) entries.
+    """
+    kinds = {v: k for k, v in PACK_TYPES.items()}
+    objects = sorted(
+        objects,
+        key=lambda o: (kinds[o[1]], pack_name_hash(o[3]), -o[2], o[0]),
+    )
+
+    entries = list()
+    recent = collections.deque(maxlen=window)
+    depths = dict()
+    checksum = hashlib.sha1()
+
+    def emit(data):
+        f.write(data)
+        checksum.update(data)
+
+    emit(b"PACK" + struct.pack(">II", 2, len(objects)))
+    offset = 12
+
+    for sha, fmt, size, name in objects:
+        raw = object_read_raw(repo, sha)
+        if not raw:
+            raise Exception("Object {} is missing".format(sha))
+        data = raw[1]
+
+        best = None
+        for base in recent:
+            if base[1] != fmt or depths[base[0]] >= depth:
+                continue
+            # Too different in size to ever make a small delta.
+            if abs(len(base[2]) - len(data)) > len(data) // 2:
+                continue
+            if base[4] is None:
+                base[4] = delta_index(base[2])
+            delta = delta_create(base[2], data, base[4])
+            limit = len(best[1]) if best else len(data) // 2 - 20
+            if len(delta) < limit:
+                best = (base, delta)
+
+        if best:
+            base, delta = best
+            header = pack_entry_header(PACK_OFS_DELTA, len(delta))
+            header += pack_ofs_encode(offset - base[3])
+            body = zlib.compress(delta)
+            depths[sha] = depths[base[0]] + 1
+        else:
+            header = pack_entry_header(kinds[fmt], len(data))
+            body = zlib.compress(data)
+            depths[sha] = 0
+
+        emit(header)
+        emit(body)
+        crc = zlib.crc32(body, zlib.crc32(header))
+        entries.append((bytes.fromhex(sha), crc, offset))
+        if len(data) >= DELTA_BLOCK:
+            recent.append([sha, fmt, data, offset, None])
+        offset += len(header) + len(body)
+
+    trailer = checksum.digest()
+    f.write(trailer)
+    return trailer, entries
+
+
+def pack_write_index(path, entries, trailer, fsync=False):
+    """
+    to write a version 2 .idx for entries of (binsha, crc32, offset).
+    """
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for binsha, crc, offset in entries:
+        fanout[binsha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    large = list()
+    offsets = list()
+    for binsha, crc, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(offset)
+
+    out = bytearray(b"\377tOc" + struct.pack(">I", 2))
+    out += struct.pack(">256I", *fanout)
+    out += b"".join(e[0] for e in entries)
+    out += struct.pack(">{}I".format(len(entries)), *(e[1] for e in entries))
+    out += struct.pack(">{}I".format(len(offsets)), *offsets)
+    out += struct.pack(">{}Q".format(len(large)), *large)
+    out += trailer
+    out += hashlib.sha1(out).digest()
+
+    # The name comes from the pack's checksum, so writers of the same pack
+    # write the same bytes; each only needs a temp file of its own.
+    fd, tmp = tempfile.mkstemp(prefix="tmp_idx_", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(out)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+BULK_CHECKIN_MIN = 64
+
+
+class GitBulkCheckin(object):
+    """
+    A pack that new objects are streamed into, undeltified, while a large
+    import runs, instead of one loose file each. Committing fixes up its
+    header, syncs it once and writes its index; until then its objects
+    are not visible to readers.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo_dir(repo, "objects", "pack", mkdir=True)
+        fd, self.tmp = tempfile.mkstemp(prefix="tmp_pack_", dir=self.path)
+        self.f = os.fdopen(fd, "w+b")
+        self.f.write(b"PACK" + struct.pack(">II", 2, 0))
+        self.entries = list()
+        self.written = set()
+        repo.bulk = self
+
+    def write(self, fmt, size, chunks):
+        """
+        to append an object whose content comes in chunks, unless the
+        repository already has it, and return its sha.
+        """
+        kinds = {v: k for k, v in PACK_TYPES.items()}
+        h = hashlib.sha1(fmt + b" " + str(size).encode() + b"\x00")
+        offset = self.f.tell()
+
+        data = pack_entry_header(kinds[fmt], size)
+        crc = zlib.crc32(data)
+        self.f.write(data)
+        z = zlib.compressobj()
+        seen = 0
+        for chunk in itertools.chain(chunks, (None,)):
+            if chunk is None:
+                data = z.flush()
+            else:
+                h.update(chunk)
+                seen += len(chunk)
+                data = z.compress(chunk)
+            crc = zlib.crc32(data, crc)
+            self.f.write(data)
+
+        sha = h.hexdigest()
+        binsha = bytes.fromhex(sha)
+        if seen != size or binsha in self.written or object_exists(self.repo, sha):
+            self.f.seek(offset)
+            self.f.truncate()
+        else:
+            self.entries.append((binsha, crc, offset))
+            self.written.add(binsha)
+        if seen != size:
+            raise Exception("Size changed while hashing: {} != {}".format(seen, size))
+        return sha
+
+    def absorb(self, path, entries):
+        """
+        to move into this pack the objects another process streamed into
+        the segment at path, with a GitBulkCheckin of its own, and remove
+        the segment. Entries are copied as they are, already compressed;
+        objects this pack already has are left out.
+        """
+        try:
+            with open(path, "rb") as f:
+                ends = [e[2] for e in entries[1:]] + [os.fstat(f.fileno()).st_size]
+                for (binsha, crc, offset), end in zip(entries, ends):
+                    if binsha in self.written:
+                        continue
+                    self.entries.append((binsha, crc, self.f.tell()))
+                    self.written.add(binsha)
+                    f.seek(offset)
+                    while offset < end:
+                        chunk = f.read(min(OBJECT_CHUNK, end - offset))
+                        self.f.write(chunk)
+                        offset += len(chunk)
+        finally:
+            os.remove(path)
+
+    def commit(self):
+        """
+        to finish the pack and make its objects visible.
+        Returns the path of its .idx, or None when nothing was written.
+        """
+        self.repo.bulk = None
+        if not self.entries:
+            return None
+
+        self.f.seek(8)
+        self.f.write(struct.pack(">I", len(self.entries)))
+        self.f.seek(0)
+        checksum = hashlib.sha1()
+        for chunk in iter(lambda: self.f.read(OBJECT_CHUNK), b""):
+            checksum.update(chunk)
+        trailer = checksum.digest()
+        self.f.write(trailer)
+        if "pack" in self.repo.fsync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.f.close()
+
+        name = os.path.join(self.path, "pack-{}".format(trailer.hex()))
+        os.replace(self.tmp, name + ".pack")
+        pack_write_index(
+            name + ".idx", self.entries, trailer, "pack-metadata" in self.repo.fsync
+        )
+        self.repo.packs = None
+        return name + ".idx"
+
+    def rollback(self):
+        """
+        to drop the pack, unless it was committed.
+        """
+        self.repo.bulk = None
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def object_exists(repo, sha):
+    """
+    whether the repository has sha, loose or packed.
+    """
+    return os.path.exists(repo_path(repo, "objects", sha[0:2], sha[2:])) or bool(
+        pack_find(repo, sha)
+    )
+
+
+class GitBlob(GitObject):
+    """
+    This defines a GitBlob object.
+    """
+
+    fmt = b"blob"
+
+    def serialize(self):
+        return self.blobdata
+
+    def deserialize(self, data):
+        self.blobdata = data
+
+
+argsp = argsubparsers.add_parser("hash-object", help="Compute object id and sha")
+
+argsp.add_argument(
+    "-t",
+    metavar="type",
+    dest="type",
+    choices=["blob", "commit", "tag", "tree"],
+    default="blob",
+    help="Specify the type of object",
+)
+
+argsp.add_argument(
+    "-w", dest="write", action="store_true", help="write Object to database"
+)
+
+argsp.add_argument(
+    "--stdin-paths",
+    dest="stdin_paths",
+    action="store_true",
+    help="read the files to hash from stdin, one per line",
+)
+
+argsp.add_argument("path", nargs="?", help="Read object from <file>")
+
+
+def cmd_hashobject(args):
+    """
+    The base kickstarter for hash-object
+    """
+    if args.write:
+        repo = repo_find()
+    else:
+        repo = None
+
+    if not args.stdin_paths:
+        if not args.path:
+            raise Exception("hash-object needs a path, or --stdin-paths.")
+        with open(args.path, "rb") as f:
+            sha = object_hash(f, args.type.encode(), repo)
+            print(sha)
+        return
+
+    # Many objects at once: stream them into a single pack.
+    bulk = GitBulkCheckin(repo) if repo else None
+    try:
+        for line in sys.stdin:
+            with open(line.rstrip("\n"), "rb") as f:
+                print(object_hash(f, args.type.encode(), repo))
+        if bulk:
+            bulk.commit()
+    finally:
+        if bulk:
+            bulk.rollback()
+
+
+def object_hash(f, fmt, repo=None):
+    """
+    to hash an object, to write it to repository if needed
+    Blobs read from a regular file are streamed in fixed-size chunks.
+    """
+    st = os.fstat(f.fileno())
+    if fmt == b"blob" and stat.S_ISREG(st.st_mode):
+        size = st.st_size - f.tell()
+        chunks = iter(lambda: f.read(OBJECT_CHUNK), b"")
+        return object_write_stream(fmt, size, chunks, repo)
+
+    data = f.read()
+
+    match fmt:
+        case b"commit":
+            obj = GitCommit(data)
+        case b"tree":
+            obj = GitTree(data)
+        case b"tag":
+            obj = GitTag(data)
+        case b"blob":
+            obj = GitBlob(data)
+        case _:
+            raise Exception("Unknown type: {}".format(fmt))
+    return object_write(obj, repo)
+
+
+def kvlmParse(raw, start=0, dct=None):
+    """
+    Key-Value List with Messages.
+    This function will help with parsing the commit fields.
+    It loops over the header lines, so headers of any length (gpgsig,
+    mergetag) are fine, and slices a memoryview so only the values are
+    copied.
+    """
+
+    if dct is None:
+        dct = collections.OrderedDict()
+
+    view = memoryview(raw)
+    end = len(raw)
+
+    while start < end:
+        nl = raw.find(b'\n', start)
+        if nl < 0:
+            nl = end
+
+        # A blank line: the rest is the message.
+        if nl == start:
+            dct[None] = bytes(view[start+1:])
+            return dct
+
+        spc = raw.find(b' ', start, nl)
+        if spc < 0:
+            spc = nl
+
+        # Continuation lines start with a space.
+        stop = nl
+        while stop + 1 < end and raw[stop+1] == 0x20:
+            stop = raw.find(b'\n', stop+1)
+            if stop < 0:
+                stop = end
+
+        key = bytes(view[start:spc])
+        value = bytes(view[spc+1:stop])
+        if stop != nl:
+            value = value.replace(b'\n ', b'\n')
+
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [ dct[key], value ]
+        else:
+            dct[key]=value
+
+        start = stop + 1
+
+    dct[None] = b''
+    return dct
+
+
+def kvlmSerialize(kvlm):
+    """
+    to write similar objects like the above function.
+    """
+
+    parts = list()
+
+    for k in kvlm.keys():
+        if k is None:
+            continue
+        value = kvlm[k]
+        if not isinstance(value, list):
+            value = [value]
+        for v in value:
+            parts.append(k)
+            parts.append(b" ")
+            parts.append(v.replace(b"\n", b"\n "))
+            parts.append(b"\n")
+
+    parts.append(b"\n")
+    parts.append(kvlm.get(None, b""))
+
+    return b"".join(parts)
+
+
+class GitCommit(GitObject):
+    """
+    this defines the class git commit and creates its objects.
+    The raw content is only parsed when kvlm is first used; tree and
+    parents just scan the first header lines.
+    """
+
+    fmt = b"commit"
+
+    def deserialize(self, data):
+        self.raw = data
+        self._kvlm = None
+        self._head = None
+
+    def serialize(self):
+        if self._kvlm is None:
+            return self.raw
+        return kvlmSerialize(self._kvlm)
+
+    def init(self):
+        self.raw = None
+        self._kvlm = dict()
+        self._head = None
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlmParse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, value):
+        self._kvlm = value
+        self._head = None
+
+    @property
+    def tree(self):
+        return self.head()[0]
+
+    @property
+    def parents(self):
+        return self.head()[1]
+
+    @property
+    def date(self):
+        """
+        the committer timestamp, read without parsing the whole commit.
+        """
+        if self._kvlm is not None:
+            line = self._kvlm.get(b"committer", b"")
+            if isinstance(line, list):
+                line = line[0]
+        else:
+            raw = self.raw
+            end = raw.find(b"\n\n")
+            start = raw.find(b"\ncommitter ", 0, end)
+            if start < 0:
+                return 0
+            line = raw[start + 11 : raw.find(b"\n", start + 1)]
+        parts = line.rsplit(b" ", 2)
+        return int(parts[1]) if len(parts) == 3 else 0
+
+    def head(self):
+        """
+        to read the tree and the parents, as hex strings.
+        """
+        if self._head is not None:
+            return self._head
+
+        tree = None
+        parents = list()
+        if self._kvlm is not None:
+            if b"tree" in self._kvlm:
+                tree = self._kvlm[b"tree"].decode("ascii")
+            values = self._kvlm.get(b"parent", [])
+            if not isinstance(values, list):
+                values = [values]
+            parents = [v.decode("ascii") for v in values]
+        else:
+            raw = self.raw
+            pos = 0
+            while True:
+                nl = raw.find(b"\n", pos)
+                if nl < 0:
+                    break
+                if raw.startswith(b"tree ", pos):
+                    tree = raw[pos + 5 : nl].decode("ascii")
+                elif raw.startswith(b"parent ", pos):
+                    parents.append(raw[pos + 7 : nl].decode("ascii"))
+                else:
+                    break
+                pos = nl + 1
+
+        self._head = (tree, parents)
+        return self._head
+
+
+argsp = argsubparsers.add_parser("log", help="Display history of a commit.")
+argsp.add_argument(
+    "-n",
+    "--max-count",
+    dest="max_count",
+    type=int,
+    default=None,
+    help="show at most this many commits",
+)
+argsp.add_argument(
+    "--first-parent",
+    dest="first_parent",
+    action="store_true",
+    help="follow only the first parent of merges",
+)
+argsp.add_argument(
+    "--oneline", action="store_true", help="show one line per commit"
+)
+argsp.add_argument("commit", default="HEAD", nargs="?", help="commit to start at")
+
+
+def cmd_log(args):
+    """
+    kickstarter for log command; paths after "--" limit the history.
+    """
+    repo = repo_find()
+    paths = [p.strip("/") for p in args.paths if p.strip("/")]
+    shas = rev_walk(
+        repo, [object_find(repo, args.commit)], args.first_parent, paths or None
+    )
+    shas = itertools.islice(shas, args.max_count)
+
+    try:
+        if args.oneline:
+            log_oneline(repo, shas)
+        else:
+            print("base giplog:\t")
+            log_graphiz(repo, shas, args.first_parent)
+            print()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader (head, less) is gone: stop walking quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def rev_walk(repo, shas, first_parent=False, paths=None):
+    """
+    to yield every commit reachable from shas, newest committer date
+    first. The walk is lazy: a commit is only looked at once one of its
+    children has been yielded, and the commit-graph is used when it has it.
+    With paths, only the commits that changed one of them are yielded and,
+    as in git's default history simplification, a merge that left them
+    as one parent had them is only followed down that parent.
+    """
+    heap = list()
+    seen = set()
+    order = itertools.count()
+
+    def push(sha):
+        if sha in seen:
+            return
+        seen.add(sha)
+        parents, date, _ = commit_info(repo, sha)
+        heapq.heappush(heap, (-date, next(order), sha, parents))
+
+    for sha in shas:
+        push(sha)
+
+    while heap:
+        _, _, sha, parents = heapq.heappop(heap)
+        if first_parent:
+            parents = parents[:1]
+        if not paths:
+            yield sha
+        elif not parents:
+            if commit_changed_paths(repo, sha, None, paths):
+                yield sha
+        else:
+            same = next(
+                (
+                    p
+                    for i, p in enumerate(parents)
+                    if not commit_changed_paths(repo, sha, p, paths, i == 0)
+                ),
+                None,
+            )
+            if same:
+                parents = [same]
+            else:
+                yield sha
+        for p in parents:
+            push(p)
+
+
+def commit_changed_paths(repo, sha, parent, paths, first=True):
+    """
+    whether the commit sha changed one of paths since parent (None for a
+    root commit). The changed-path Bloom filter of the commit-graph, which
+    is about the first parent, answers most of the "no"s without reading
+    a tree; otherwise only the trees along the paths are compared.
+    """
+    graph = repo_commit_graph(repo)
+    if first and graph and graph.bloom:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None and not graph.bloom_maybe(pos, paths):
+            return False
+
+    old = commit_tree(repo, parent) if parent else None
+    new = commit_tree(repo, sha)
+    return any(tree_path_changed(repo, old, new, path) for path in paths)
+
+
+def commit_tree(repo, sha):
+    """
+    the tree of commit sha, from the commit-graph when it has it.
+    """
+    graph = repo_commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            return graph.entry(pos)[0]
+    return object_read(repo, sha).tree
+
+
+def tree_path_changed(repo, a, b, path):
+    """
+    whether path, a file or a directory, differs between the trees a and b.
+    Only the trees along path are read, and only until they are the same.
+    """
+    parts = path.encode("utf8").split(b"/")
+    for i, part in enumerate(parts):
+        if a == b:
+            return False
+        x = object_read(repo, a).find(part) if a else None
+        y = object_read(repo, b).find(part) if b else None
+        if i == len(parts) - 1:
+            return (x and (x.mode, x.binsha)) != (y and (y.mode, y.binsha))
+        a = x.sha if x and x.is_tree() else None
+        b = y.sha if y and y.is_tree() else None
+    return False
+
+
+def log_oneline(repo, shas):
+    """
+    to print the short sha and the subject of every commit.
+    """
+    for sha in shas:
+        print("{} {}".format(sha[0:7], commit_subject(object_read(repo, sha))))
+
+
+def commit_subject(commit):
+    """
+    the first line of the commit message.
+    """
+    message = commit.kvlm[None].decode("utf8").strip()
+    if "\n" in message:
+        message = message[: message.index("\n")]
+    return message
+
+
+def log_graphiz(repo, shas, first_parent=False):
+    """
+    We will use graphiz software to show log in a graphical representation.
+    """
+    for sha in shas:
+        commit = object_read(repo, sha)
+        message = commit_subject(commit)
+        message = message.replace("\\", "\\\\")
+        message = message.replace('"', '\\"')
+
+        print('\tc_{} [label="{}: {}"]'.format(sha, sha[0:7], message))
+
+        parents = commit.parents
+        if first_parent:
+            parents = parents[:1]
+        for p in parents:
+            print("\tc_{} -> c_{}".format(sha, p))
+            print("\n\t", "-" * 100, "\n")
+
+
+GENERATION_INFINITY = 0xFFFFFFFF
+GRAPH_NO_PARENT = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+# Changed-path Bloom filters, as git writes them: 7 hashes, 10 bits per
+# path, and one "everything changed" byte past 512 changed files.
+BLOOM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGES = 512
+
+
+def murmur3(data, seed, signed=False):
+    """
+    the 32-bit murmur3 hash of data. git's version 1 filters read the
+    bytes as signed chars, so bytes from 0x80 up are sign-extended.
+    """
+
+    def byte(b):
+        return b | 0xFFFFFF00 if signed and b & 0x80 else b
+
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & 0xFFFFFFFF
+
+    c1, c2 = 0xCC9E2D51, 0x1B873593
+    h = seed
+    end = len(data) & ~3
+    for i in range(0, end, 4):
+        k = (
+            byte(data[i])
+            | byte(data[i + 1]) << 8
+            | byte(data[i + 2]) << 16
+            | byte(data[i + 3]) << 24
+        ) & 0xFFFFFFFF
+        k = rotl(k * c1 & 0xFFFFFFFF, 15) * c2 & 0xFFFFFFFF
+        h = (rotl(h ^ k, 13) * 5 + 0xE6546B64) & 0xFFFFFFFF
+
+    k = 0
+    for i in reversed(range(end, len(data))):
+        k ^= byte(data[i]) << (8 * (i - end))
+    if len(data) & 3:
+        k = rotl(k * c1 & 0xFFFFFFFF, 15) * c2 & 0xFFFFFFFF
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = h * 0x85EBCA6B & 0xFFFFFFFF
+    h ^= h >> 13
+    h = h * 0xC2B2AE35 & 0xFFFFFFFF
+    return h ^ (h >> 16)
+
+
+def bloom_key(path, version=1, hashes=BLOOM_HASHES):
+    """
+    the bit hashes of path (bytes) in a changed-path Bloom filter.
+    """
+    h0 = murmur3(path, 0x293AE76F, version == 1)
+    h1 = murmur3(path, 0x7E646E2C, version == 1)
+    return [(h0 + i * h1) & 0xFFFFFFFF for i in range(hashes)]
+
+
+def bloom_contains(bloom, key):
+    """
+    False when the filter bloom surely does not hold key.
+    """
+    bits = len(bloom) * 8
+    for h in key:
+        pos = h % bits
+        if not bloom[pos >> 3] & (1 << (pos & 7)):
+            return False
+    return True
+
+
+def bloom_build(repo, old, new):
+    """
+    the changed-path Bloom filter of a commit with tree new, against the
+    tree old of its first parent (None for a root): every changed file and
+    all its leading directories.
+    """
+    paths = set()
+    for n, change in enumerate(tree_diff(repo, old, new)):
+        if n == BLOOM_MAX_CHANGES:
+            return b"\xff"
+        path = change[0].encode("utf8")
+        while path and path not in paths:
+            paths.add(path)
+            path = path.rpartition(b"/")[0]
+
+    bloom = bytearray(max(1, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8))
+    bits = len(bloom) * 8
+    for path in paths:
+        for h in bloom_key(path):
+            pos = h % bits
+            bloom[pos >> 3] |= 1 << (pos & 7)
+    return bytes(bloom)
+
+
+class GitCommitGraph(object):
+    """
+    A memory-mapped commit-graph file: the parents, root tree, date and
+    generation number of every commit it holds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if data[0:4] != b"CGPH" or data[4] != 1 or data[5] != 1:
+            raise Exception("Unsupported commit-graph {}".format(path))
+
+        # The chunk table ends with a zero id holding the end offset.
+        table = [
+            struct.unpack_from(">4sQ", data, 8 + 12 * i) for i in range(data[6] + 1)
+        ]
+        self.chunks = dict()
+        for (cid, start), (_, end) in zip(table, table[1:]):
+            self.chunks[cid] = (start, end)
+
+        for cid in (b"OIDF", b"OIDL", b"CDAT"):
+            if cid not in self.chunks:
+                raise Exception("Malformed commit-graph {}".format(path))
+
+        self.fanout = struct.unpack_from(">256I", data, self.chunks[b"OIDF"][0])
+        self.count = self.fanout[255]
+        self.oids = self.chunks[b"OIDL"][0]
+        self.cdat = self.chunks[b"CDAT"][0]
+        self.edges = self.chunks.get(b"EDGE", (None,))[0]
+
+        # Changed-path Bloom filters: BIDX holds where each commit's filter
+        # ends in BDAT, and BDAT starts with the filters' settings.
+        self.bloom = None
+        self.bloom_keys = dict()
+        if b"BIDX" in self.chunks and b"BDAT" in self.chunks:
+            self.bidx = self.chunks[b"BIDX"][0]
+            self.bdat = self.chunks[b"BDAT"][0] + 12
+            settings = struct.unpack_from(">3I", data, self.bdat - 12)
+            if settings[0] in (1, 2):
+                self.bloom = settings
+
+    def find(self, binsha):
+        """
+        the position of binsha in the graph, or None.
+        """
+        return fanout_find(self.data, self.fanout, self.oids, binsha)
+
+    def sha(self, pos):
+        start = self.oids + 20 * pos
+        return self.data[start : start + 20].hex()
+
+    def entry(self, pos):
+        """
+        to read (tree, parents, date, generation) of the commit at pos.
+        """
+        start = self.cdat + 36 * pos
+        tree = self.data[start : start + 20].hex()
+        p1, p2, high, low = struct.unpack_from(">IIII", self.data, start + 20)
+
+        parents = list()
+        if p1 != GRAPH_NO_PARENT:
+            parents.append(self.sha(p1))
+        if p2 & GRAPH_EXTRA_EDGES and p2 != GRAPH_NO_PARENT:
+            i = p2 & ~GRAPH_EXTRA_EDGES
+            while True:
+                (edge,) = struct.unpack_from(">I", self.data, self.edges + 4 * i)
+                parents.append(self.sha(edge & ~GRAPH_LAST_EDGE))
+                if edge & GRAPH_LAST_EDGE:
+                    break
+                i += 1
+        elif p2 != GRAPH_NO_PARENT:
+            parents.append(self.sha(p2))
+
+        date = ((high & 3) << 32) | low
+        return tree, parents, date, high >> 2
+
+    def bloom_filter(self, pos):
+        """
+        the changed-path Bloom filter of the commit at pos; empty if the
+        graph has none for it.
+        """
+        if not self.bloom:
+            return b""
+        end = struct.unpack_from(">I", self.data, self.bidx + 4 * pos)[0]
+        start = (
+            struct.unpack_from(">I", self.data, self.bidx + 4 * pos - 4)[0]
+            if pos
+            else 0
+        )
+        return self.data[self.bdat + start : self.bdat + end]
+
+    def bloom_maybe(self, pos, paths):
+        """
+        False when the Bloom filter of the commit at pos says it changed
+        none of paths. A path only counts if its directories are in too.
+        """
+        bloom = self.bloom_filter(pos)
+        if not bloom:
+            return True
+
+        key = tuple(paths)
+        if key not in self.bloom_keys:
+            version, hashes, _ = self.bloom
+            keys = list()
+            for path in paths:
+                parts = path.encode("utf8").split(b"/")
+                keys.append(
+                    [
+                        bloom_key(b"/".join(parts[: i + 1]), version, hashes)
+                        for i in range(len(parts))
+                    ]
+                )
+            self.bloom_keys[key] = keys
+
+        return any(
+            all(bloom_contains(bloom, k) for k in path)
+            for path in self.bloom_keys[key]
+        )
+
+
+def repo_commit_graph(repo):
+    """
+    to load, once, objects/info/commit-graph if there is one.
+    """
+    if repo.graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        repo.graph = GitCommitGraph(path) if os.path.isfile(path) else False
+    return repo.graph
+
+
+def commit_info(repo, sha):
+    """
+    to get (parents, date, generation) of a commit, from the commit-graph
+    when it holds the commit, or else from the commit object itself.
+    """
+    graph = repo_commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            _, parents, date, generation = graph.entry(pos)
+            return parents, date, generation
+
+    commit = object_read(repo, sha)
+    if not commit or commit.fmt != b"commit":
+        raise Exception("{} is not a commit object".format(sha))
+    return commit.parents, commit.date, GENERATION_INFINITY
+
+
+argsp = argsubparsers.add_parser(
+    "commit-graph", help="Write the commit-graph file"
+)
+argsp.add_argument("action", choices=["write"], help="what to do")
+argsp.add_argument(
+    "--changed-paths",
+    dest="changed_paths",
+    action="store_true",
+    default=None,
+    help="also write changed-path Bloom filters, for log -- <path>",
+)
+argsp.add_argument(
+    "--no-changed-paths",
+    dest="changed_paths",
+    action="store_false",
+    help="drop the changed-path Bloom filters",
+)
+
+
+def cmd_commitgraph(args):
+    """
+    kickstarter for commit-graph command.
+    """
+    repo = repo_find()
+    commit_graph_write(repo, args.changed_paths)
+
+
+def commit_peel(repo, sha):
+    """
+    to follow tags down to a commit; None if sha is not a commit-ish.
+    """
+    while True:
+        obj = object_read(repo, sha)
+        if not obj:
+            return None
+        if obj.fmt == b"commit":
+            return sha
+        if obj.fmt != b"tag":
+            return None
+        sha = obj.kvlm[b"object"].decode("ascii")
+
+
+def commit_graph_write(repo, changed_paths=None):
+    """
+    to write a commit-graph of every commit reachable from the refs. With
+    changed_paths it also holds changed-path Bloom filters; left at None,
+    it keeps them if the current graph has them.
+    """
+    old = repo_commit_graph(repo)
+    if changed_paths is None:
+        changed_paths = bool(old and old.bloom)
+    tips = [commit_peel(repo, sha) for sha in repo_tips(repo)]
+    commits = dict()
+    for sha in rev_walk(repo, [t for t in tips if t]):
+        commit = object_read(repo, sha)
+        commits[sha] = (commit.tree, commit.parents, commit.date)
+
+    # Generation numbers: 1 for roots, one more than the highest parent.
+    generations = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            parents = commits[top][1]
+            missing = [p for p in parents if p not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+            generations[top] = min(
+                1 + max((generations[p] for p in parents), default=0), 0x3FFFFFFF
+            )
+            stack.pop()
+
+    shas = sorted(commits)
+    positions = {sha: i for i, sha in enumerate(shas)}
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    cdat = bytearray()
+    edges = list()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        pos = [positions[p] for p in parents]
+        p1 = pos[0] if pos else GRAPH_NO_PARENT
+        if len(pos) > 2:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(pos[1:-1])
+            edges.append(GRAPH_LAST_EDGE | pos[-1])
+        else:
+            p2 = pos[1] if len(pos) == 2 else GRAPH_NO_PARENT
+        high = (generations[sha] << 2) | ((date >> 32) & 3)
+        cdat += bytes.fromhex(tree)
+        cdat += struct.pack(">IIII", p1, p2, high, date & 0xFFFFFFFF)
+
+    chunks = [
+        (b"OIDF", struct.pack(">256I", *fanout)),
+        (b"OIDL", b"".join(bytes.fromhex(sha) for sha in shas)),
+        (b"CDAT", bytes(cdat)),
+    ]
+    if edges:
+        chunks.append((b"EDGE", struct.pack(">{}I".format(len(edges)), *edges)))
+
+    if changed_paths:
+        # Filters the current graph already has are reused as they are.
+        reuse = old and old.bloom == (1, BLOOM_HASHES, BLOOM_BITS_PER_ENTRY)
+        bidx = list()
+        bdat = [struct.pack(">3I", 1, BLOOM_HASHES, BLOOM_BITS_PER_ENTRY)]
+        end = 0
+        for sha in shas:
+            pos = old.find(bytes.fromhex(sha)) if reuse else None
+            bloom = old.bloom_filter(pos) if pos is not None else b""
+            if not bloom:
+                tree, parents, _ = commits[sha]
+                parent = commits[parents[0]][0] if parents else None
+                bloom = bloom_build(repo, parent, tree)
+            bdat.append(bytes(bloom))
+            end += len(bloom)
+            bidx.append(end)
+        chunks.append((b"BIDX", struct.pack(">{}I".format(len(bidx)), *bidx)))
+        chunks.append((b"BDAT", b"".join(bdat)))
+
+    commit_graph_save(repo, chunks)
+
+
+def commit_graph_save(repo, chunks):
+    """
+    to write the chunks as objects/info/commit-graph, with its header,
+    chunk table and checksum.
+    """
+    out = bytearray(b"CGPH" + bytes([1, 1, len(chunks), 0]))
+    offset = len(out) + 12 * (len(chunks) + 1)
+    for cid, data in chunks:
+        out += struct.pack(">4sQ", cid, offset)
+        offset += len(data)
+    out += struct.pack(">4sQ", b"\x00" * 4, offset)
+    for cid, data in chunks:
+        out += data
+    out += hashlib.sha1(out).digest()
+
+    lock = GitLockFile(repo_file(repo, "objects", "info", "commit-graph", mkdir=True))
+    try:
+        lock.write(out)
+        lock.commit("commit-graph" in repo.fsync)
+    finally:
+        lock.rollback()
+    repo.graph = None
+
+
+argsp = argsubparsers.add_parser("merge-base", help="Find a common ancestor")
+argsp.add_argument(
+    "--is-ancestor",
+    dest="is_ancestor",
+    action="store_true",
+    help="exit with 0 when the first commit is an ancestor of the second",
+)
+argsp.add_argument("commit1", help="a commit")
+argsp.add_argument("commit2", help="another commit")
+
+
+def cmd_mergebase(args):
+    """
+    kickstarter for merge-base command.
+    """
+    repo = repo_find()
+    a = object_find(repo, args.commit1, fmt=b"commit")
+    b = object_find(repo, args.commit2, fmt=b"commit")
+
+    if args.is_ancestor:
+        sys.exit(0 if commit_is_ancestor(repo, a, b) else 1)
+
+    bases = merge_base(repo, a, b)
+    if not bases:
+        sys.exit(1)
+    for sha in bases:
+        print(sha)
+
+
+def commit_is_ancestor(repo, a, b):
+    """
+    to tell whether a is reachable from b.
+    With generation numbers, commits older than a are never expanded, and
+    a bitmap for b answers at once.
+    """
+    bitmap = repo_bitmap(repo)
+    if bitmap:
+        reach, pos = bitmap.bitmap(b), bitmap.position(a)
+        if reach is not None and pos is not None:
+            return bool(reach >> pos & 1)
+
+    limit = commit_info(repo, a)[2]
+    if limit == GENERATION_INFINITY:
+        limit = 0
+
+    stack = [b]
+    seen = {b}
+    while stack:
+        sha = stack.pop()
+        if sha == a:
+            return True
+        parents, _, generation = commit_info(repo, sha)
+        # Only commits with a higher generation can reach a.
+        if generation <= limit:
+            continue
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                stack.append(p)
+    return False
+
+
+def merge_base(repo, a, b):
+    """
+    to find the best common ancestors of a and b.
+    Both sides are painted down, newest first, until only commits reachable
+    from a common ancestor are left in the queue.
+    """
+    one, two, stale = 1, 2, 4
+    flags = collections.defaultdict(int)
+    heap = list()
+    order = itertools.count()
+
+    def push(sha, flag):
+        if flags[sha] & flag == flag:
+            return
+        flags[sha] |= flag
+        _, date, generation = commit_info(repo, sha)
+        heapq.heappush(heap, (-generation, -date, next(order), sha))
+
+    push(a, one)
+    push(b, two)
+    found = list()
+    while any(not flags[e[3]] & stale for e in heap):
+        _, _, _, sha = heapq.heappop(heap)
+        flag = flags[sha] & (one | two | stale)
+        if flag == one | two:
+            if sha not in found:
+                found.append(sha)
+            flag |= stale
+        for p in commit_info(repo, sha)[0]:
+            push(p, flag)
+
+    # Drop the bases that are ancestors of other bases.
+    return [
+        x
+        for x in found
+        if not any(y != x and commit_is_ancestor(repo, x, y) for y in found)
+    ]
+
+
+argsp = argsubparsers.add_parser("ls-tree", help="print a tree object")
+argsp.add_argument(
+    "-r", dest="recursive", action="store_true", help="recursive into trees"
+)
+argsp.add_argument("tree", help="a tree-like object")
+
+
+def cmd_lstree(args):
+    """
+    kickstarter for ls-tree command.
+    """
+    repo = repo_find()
+    ls_tree(repo, args.tree, args.recursive)
+
+
+def ls_tree(repo, ref, recursive=None, prefix=""):
+    sha = object_find(repo, ref, fmt=b"tree")
+    obj = object_read(repo, sha)
+    for item in obj.items:
+        mode = item.mode.rjust(6, b"0")
+
+        match mode[0:2]: # Determine the type.
+            case b'04': type = "tree"
+            case b'10': type = "blob" # A regular file.
+            case b'12': type = "blob" # A symlink. Blob contents is link target.
+            case b'16': type = "commit" # A submodule
+            case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
+
+        if not (recursive and type=='tree'): # This is a leaf
+            print("{0} {1} {2}\t{3}".format(
+                mode.decode("ascii"),
+                # Git's ls-tree displays the type
+                # of the object pointed to.  We can do that too :)
+                type,
+                item.sha,
+                os.path.join(prefix, item.path)))
+        else: # This is a branch, recurse
+            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+
+
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content and mode of two trees")
+argsp.add_argument("-r", dest="recurse", action="store_true", help="recurse into subtrees")
+argsp.add_argument(
+    "--root", action="store_true", help="show a root commit as adding every file"
+)
+argsp.add_argument(
+    "--name-only", dest="format", action="store_const", const="name-only", help="show names only"
+)
+argsp.add_argument(
+    "--name-status",
+    dest="format",
+    action="store_const",
+    const="name-status",
+    help="show names and the kind of change",
+)
+argsp.add_argument(
+    "--stat", dest="format", action="store_const", const="stat", help="show a diffstat"
+)
+argsp.add_argument("tree1", help="a tree-ish, or a commit to compare with its parent")
+argsp.add_argument("tree2", nargs="?", help="a tree-ish")
+
+
+def cmd_difftree(args):
+    """
+    kickstarter for diff-tree command.
+    """
+    repo = repo_find()
+    header = None
+    if args.tree2:
+        a = object_find(repo, args.tree1, b"tree")
+        b = object_find(repo, args.tree2, b"tree")
+    else:
+        header = object_find(repo, args.tree1, b"commit")
+        commit = object_read(repo, header)
+        # Like git without -m/-c, a merge commit shows no diff.
+        if not (commit.parents or args.root) or len(commit.parents) > 1:
+            return
+        a = object_read(repo, commit.parents[0]).tree if commit.parents else None
+        b = commit.tree
+
+    # A diffstat is always about files.
+    changes = tree_diff(repo, a, b, recurse=args.recurse or args.format == "stat")
+    if header:
+        print(header)
+    if args.format == "stat":
+        diff_stat(repo, changes)
+        return
+    for path, old_mode, old_sha, new_mode, new_sha in changes:
+        status = diff_status(old_mode, new_mode)
+        if args.format == "name-only":
+            print(path)
+        elif args.format == "name-status":
+            print("{}\t{}".format(status, path))
+        else:
+            print(
+                ":{:06o} {:06o} {} {} {}\t{}".format(
+                    int(old_mode or b"0", 8),
+                    int(new_mode or b"0", 8),
+                    old_sha or ZERO_SHA,
+                    new_sha or ZERO_SHA,
+                    status,
+                    path,
+                )
+            )
+
+
+def diff_status(old_mode, new_mode):
+    """
+    the letter git shows for a change: Added, Deleted, Type changed or Modified.
+    """
+    if not old_mode:
+        return "A"
+    if not new_mode:
+        return "D"
+    if int(old_mode, 8) & 0o170000 != int(new_mode, 8) & 0o170000:
+        return "T"
+    return "M"
+
+
+def diff_stat(repo, changes, width=80):
+    """
+    to print git's diffstat of changes: one line per file with its count
+    of changed lines and a +/- graph scaled to width, then totals.
+    """
+    files = list()
+    for path, old_mode, old_sha, new_mode, new_sha in changes:
+        old = object_read(repo, old_sha).blobdata if old_sha else b""
+        new = object_read(repo, new_sha).blobdata if new_sha else b""
+        if b"\x00" in old[:8000] or b"\x00" in new[:8000]:
+            files.append((path, len(new), len(old), True))
+        else:
+            files.append((path,) + diff_count(diff_split(old), diff_split(new)) + (False,))
+
+    max_len = max((len(f[0]) for f in files), default=0)
+    max_change = max((f[1] + f[2] for f in files if not f[3]), default=0)
+    bin_width = max((14 + len(str(f[1])) + len(str(f[2])) for f in files if f[3]), default=0)
+    number_width = max(len(str(max_change)), 3 if bin_width else 0)
+    width = max(width, 16 + 6 + number_width)
+
+    # The same budget as git: names get 5/8 and the graph 3/8 of the width.
+    graph_width = max_change if max_change + 4 > bin_width else bin_width - 4
+    name_width = max_len
+    if name_width + number_width + 6 + graph_width > width:
+        if graph_width > width * 3 // 8 - number_width - 6:
+            graph_width = max(width * 3 // 8 - number_width - 6, 6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+
+    def scale(n):
+        return 1 + (n * (graph_width - 1) // max_change) if n else 0
+
+    added = deleted = 0
+    for path, add, delete, binary in files:
+        prefix = ""
+        if len(path) > name_width:
+            prefix = "..."
+            path = path[len(path) - max(name_width - 3, 0) :]
+            if "/" in path:
+                path = path[path.index("/") :]
+        line = " {}{:<{}} |".format(prefix, path, name_width - len(prefix))
+        if binary:
+            line += " {:>{}}".format("Bin", number_width)
+            if add or delete:
+                line += " {} -> {} bytes".format(delete, add)
+            print(line)
+            continue
+
+        added += add
+        deleted += delete
+        total = add + delete
+        plus, minus = add, delete
+        if graph_width <= max_change:
+            total_width = scale(total)
+            if total_width < 2 and add and delete:
+                total_width = 2
+            if add < delete:
+                plus = scale(add)
+                minus = total_width - plus
+            else:
+                minus = scale(delete)
+                plus = total_width - minus
+        line += " {:>{}}{}".format(total, number_width, " " if total else "")
+        print(line + "+" * plus + "-" * minus)
+
+    summary = " {} file{} changed".format(len(files), "" if len(files) == 1 else "s")
+    if not files:
+        print(" 0 files changed")
+        return
+    if added or not deleted:
+        summary += ", {} insertion{}(+)".format(added, "" if added == 1 else "s")
+    if deleted or not added:
+        summary += ", {} deletion{}(-)".format(deleted, "" if deleted == 1 else "s")
+    print(summary)
+
+
+DIFF_MAX_COST = 2000
+
+
+def diff_split(data):
+    """
+    to split data into lines, keeping their newline, as git counts them.
+    """
+    lines = data.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def diff_count(a, b):
+    """
+    to count the lines added and deleted by a minimal diff of a to b.
+    The edit distance d is found with Myers' greedy algorithm, which takes
+    time in proportion to (len(a) + len(b)) * d; past DIFF_MAX_COST, a
+    difflib diff, not always minimal, is counted instead.
+    """
+    head = 0
+    while head < len(a) and head < len(b) and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < len(a) - head and tail < len(b) - head and a[-1 - tail] == b[-1 - tail]:
+        tail += 1
+    a, b = a[head : len(a) - tail], b[head : len(b) - tail]
+    n, m = len(a), len(b)
+    if not (n and m):
+        return m, n
+
+    # Lines as small ints compare faster.
+    ids = dict()
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+
+    offset = n + m
+    v = [0] * (2 * offset + 2)
+    for d in range(min(n + m, DIFF_MAX_COST) + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return (d + m - n) // 2, (d - m + n) // 2
+
+    added = deleted = 0
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            deleted += i2 - i1
+            added += j2 - j1
+    return added, deleted
+
+
+class GitTreeLeaf(object):
+    """
+    This defines a git tree leaf object.
+    It keeps the raw bytes of the tree entry; path and sha are only
+    decoded when they are read.
+    """
+
+    __slots__ = ("mode", "name", "binsha")
+
+    def __init__(self, mode, path, sha):
+        self.mode = mode
+        self.name = path.encode("utf8") if isinstance(path, str) else path
+        self.binsha = bytes.fromhex(sha) if isinstance(sha, str) else sha
+
+    @property
+    def path(self):
+        return self.name.decode("utf8")
+
+    @path.setter
+    def path(self, value):
+        self.name = value.encode("utf8")
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value)
+
+    def is_tree(self):
+        return self.mode.startswith(b"4")
+
+
+def tree_parse_one(content, start=0):
+    """
+    this parser is made to extract a single record.
+    """
+    x = content.find(b" ", start)
+    assert x - start == 5 or x - start == 6
+    y = content.find(b"\x00", x)
+
+    return (y + 21, GitTreeLeaf(content[start:x], content[x + 1 : y], content[y + 1 : y + 21]))
+
+
+def tree_parse(content):
+    """
+    this will call the above function for every record.
     """
 
     pos = 0
@@ -648,224 +2949,2890 @@ def tree_parse(content):
         pos, data = tree_parse_one(content, pos)
         rtn.append(data)
 
-    return rtn
+    return rtn
+
+
+def TreeLeaf_SortKey(leaf):
+    """
+    git compares names as bytes, as if trees ended with a slash.
+    """
+    if leaf.is_tree():
+        return leaf.name + b"/"
+    else:
+        return leaf.name
+
+
+def tree_serialize(obj):
+    """
+    to serialize and turn object to sha.
+    """
+
+    parts = list()
+    for i in sorted(obj.items, key=TreeLeaf_SortKey):
+        parts.append(i.mode)
+        parts.append(b" ")
+        parts.append(i.name)
+        parts.append(b"\x00")
+        parts.append(i.binsha)
+    return b"".join(parts)
+
+
+class GitTree(GitObject):
+    """
+    defines a git tree object.
+    The entries are only parsed when items is first used.
+    """
+
+    fmt = b"tree"
+
+    def deserialize(self, data):
+        self.raw = data
+        self._items = None
+        self._names = None
+
+    def serialize(self):
+        if self._items is None:
+            return self.raw
+        return tree_serialize(self)
+
+    def init(self):
+        self.raw = None
+        self._items = list()
+        self._names = None
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = tree_parse(self.raw)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+        self._names = None
+
+    def find(self, name):
+        """
+        the leaf called name (bytes), or None.
+        """
+        if self._names is None:
+            self._names = {leaf.name: leaf for leaf in self.items}
+        return self._names.get(name)
+
+
+argsp = argsubparsers.add_parser(
+    "checkout", help="checkout a commit inside of a directory"
+)
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=None,
+    help="number of files written in parallel",
+)
+argsp.add_argument(
+    "--pack-order",
+    dest="pack_order",
+    action="store_true",
+    help="write files in the order their blobs are stored in packs",
+)
+argsp.add_argument("commit", help="The commit to checkout")
+argsp.add_argument("path", help="the empty directory to checkout on")
+
+
+def cmd_checkout(args):
+    """
+    a kickstarter function
+    """
+    repo = repo_find()
+    path = os.path.realpath(args.path)
+    if os.path.exists(path):
+        if not os.path.isdir(path):
+            raise Exception("Not a directory: {}".format(args.path))
+        if os.listdir(path):
+            # Only the worktree has a known current tree: HEAD's.
+            if path != os.path.realpath(repo.worktree):
+                raise Exception("Not empty: {}".format(args.path))
+            worktree_switch(repo, args.commit, jobs=args.jobs)
+            return
+    else:
+        os.makedirs(path)
+
+    obj = object_read(repo, object_find(repo, args.commit, fmt=b"tree"))
+    tree_checkout(repo, obj, path, jobs=args.jobs, pack_order=args.pack_order)
+
+
+def worktree_switch(repo, name, jobs=None):
+    """
+    to move the worktree, the index and HEAD from HEAD's commit to the
+    commit name stands for, under the index lock.
+    """
+    commit = object_find(repo, name, fmt=b"commit")
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        head = ref_resolve(repo, "HEAD")
+        old = object_read(repo, head).tree if head else None
+        new = object_read(repo, commit).tree
+        tree_checkout_incremental(repo, old, new, repo.worktree, jobs, index)
+        index_write(repo, index, lock)
+    finally:
+        lock.rollback()
+    head_update(repo, name, commit)
+
+
+def tree_flatten(repo, tree, prefix=""):
+    """
+    to list the directories and the (path, mode, sha) files of a tree.
+    """
+    dirs = list()
+    files = list()
+    stack = [(tree, prefix)]
+    while stack:
+        tree, prefix = stack.pop()
+        for item in tree.items:
+            path = os.path.join(prefix, item.path)
+            if item.is_tree():
+                dirs.append(path)
+                stack.append((object_read(repo, item.sha), path))
+            elif item.mode != b"160000":
+                files.append((path, item.mode, item.sha))
+    return dirs, files
+
+
+def tree_checkout(repo, tree, path, jobs=None, pack_order=False):
+    """
+    to write a whole tree under path.
+    The tree is gathered first, directories are made in one pass, then
+    blobs are inflated and written by a pool of threads (zlib and file
+    writes release the GIL).
+    """
+    dirs, files = tree_flatten(repo, tree)
+    for d in sorted(dirs):
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+
+    checkout_files(repo, path, files, jobs, pack_order)
+
+
+def checkout_files(repo, path, files, jobs=None, pack_order=False):
+    """
+    to write (path, mode, sha) files under path, on a pool of threads.
+    """
+    if jobs is None:
+        jobs = repo.conf.getint("checkout", "workers", fallback=0) or os.cpu_count() or 1
+
+    if pack_order:
+        files.sort(key=lambda f: checkout_pack_order(repo, f[2]))
+
+    def write(f):
+        dest = os.path.join(path, f[0])
+        # Writing through a symlink would change its target instead.
+        if os.path.islink(dest) or (f[1] == b"120000" and os.path.lexists(dest)):
+            os.remove(dest)
+        if f[1] == b"120000":
+            os.symlink(object_read(repo, f[2]).blobdata.decode("utf8"), dest)
+            return
+        blob_checkout(repo, f[2], dest)
+        # Executable files get an x bit wherever they have an r bit.
+        mode = os.lstat(dest).st_mode & 0o777
+        if f[1] == b"100755":
+            mode |= (mode & 0o444) >> 2
+        else:
+            mode &= ~0o111
+        os.chmod(dest, mode)
+
+    if jobs <= 1 or len(files) < 2:
+        for f in files:
+            write(f)
+        return
+
+    # Load the packs before the workers race for them.
+    repo_packs(repo)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for _ in pool.map(write, files):
+            pass
+
+
+def tree_checkout_incremental(repo, old, new, path, jobs=None, index=None):
+    """
+    to turn the checkout of tree old under path into one of tree new,
+    touching only the files that differ. Files with local changes, and
+    untracked files in the way, are never overwritten. With index, the
+    entries of the changed files follow, staged changes to them stop the
+    checkout, and the cached tree is invalidated along their paths.
+    """
+    changes = list(tree_diff(repo, old, new))
+    entries = {e.name: e for e in index.entries} if index else dict()
+    deleted = {c[0] for c in changes if c[4] is None}
+
+    for name, old_mode, old_blob, new_mode, new_blob in changes:
+        entry = entries.get(name)
+        if index and (entry.sha if entry else None) not in (old_blob, new_blob):
+            raise Exception("Staged changes to {} would be overwritten".format(name))
+        dest = os.path.join(path, name)
+        # A directory in the way must be emptied by the deletions below.
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            for dirpath, dirnames, filenames in os.walk(dest):
+                links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+                for f in filenames + links:
+                    rel = os.path.relpath(os.path.join(dirpath, f), path)
+                    if rel.replace(os.sep, "/") not in deleted:
+                        raise Exception("Untracked file {} would be removed".format(rel))
+            continue
+        if not os.path.lexists(dest):
+            continue
+        current = worktree_hash(repo, dest, os.lstat(dest))
+        if old_blob:
+            if current != old_blob and current != new_blob:
+                raise Exception("Local changes to {} would be overwritten".format(name))
+        elif current != new_blob:
+            raise Exception("Untracked file {} would be overwritten".format(name))
+
+    files = list()
+    for name, old_mode, old_blob, new_mode, new_blob in changes:
+        dest = os.path.join(path, name)
+        if new_blob is None:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            dirs_prune(path, os.path.dirname(dest))
+        else:
+            files.append((name, new_mode, new_blob))
+
+    for name, mode, sha in files:
+        dest = os.path.join(path, name)
+        # A directory that became a file was emptied by the deletions.
+        if os.path.isdir(dest):
+            os.rmdir(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    checkout_files(repo, path, files, jobs)
+
+    if index:
+        for name, old_mode, old_blob, new_mode, new_blob in changes:
+            index.invalidate(name)
+            entries.pop(name, None)
+        index.entries = [e for e in index.entries if e.name in entries]
+        for name, mode, sha in files:
+            entry = GitIndexEntry(name=name)
+            index_entry_stat(entry, os.lstat(os.path.join(path, name)))
+            entry.sha = sha
+            entry.mode = int(mode, 8)
+            index.entries.append(entry)
+
+
+def tree_diff(repo, a, b, prefix="", recurse=True):
+    """
+    to yield (path, old mode, old sha, new mode, new sha) for every file
+    that differs between the trees a and b (shas, or None for nothing).
+    Both trees are walked in git order and subtrees with the same sha on
+    both sides are skipped without being read. Without recurse, changed
+    subtrees are yielded as they are instead of walked.
+    """
+    if a == b:
+        return
+    left = object_read(repo, a).items if a else []
+    right = object_read(repo, b).items if b else []
+    left = sorted(left, key=TreeLeaf_SortKey)
+    right = sorted(right, key=TreeLeaf_SortKey)
+
+    # Merging on the sort key, a tree and a file of the same name are two
+    # entries, so a type change is a delete plus an add, as in git.
+    i = j = 0
+    while i < len(left) or j < len(right):
+        x = left[i] if i < len(left) else None
+        y = right[j] if j < len(right) else None
+        kx = TreeLeaf_SortKey(x) if x else None
+        ky = TreeLeaf_SortKey(y) if y else None
+        if x and y and kx == ky:
+            i += 1
+            j += 1
+        elif y is None or (x and kx < ky):
+            i += 1
+            y = None
+        else:
+            j += 1
+            x = None
+
+        entry = x or y
+        path = os.path.join(prefix, entry.path)
+        if x and y and x.binsha == y.binsha and x.mode == y.mode:
+            continue
+        if entry.is_tree() and recurse:
+            yield from tree_diff(repo, x and x.sha, y and y.sha, path)
+        elif entry.mode != b"160000":
+            yield (
+                path,
+                x.mode if x else None,
+                x.sha if x else None,
+                y.mode if y else None,
+                y.sha if y else None,
+            )
+
+
+def dirs_prune(root, path):
+    """
+    to remove path and its parents, up to root, while they are empty.
+    """
+    while path != root and os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
+
+def head_update(repo, name, sha):
+    """
+    to point HEAD at the branch name if there is one, or else at sha.
+    """
+    if ref_store(repo).read("refs/heads/" + name):
+        data = "ref: refs/heads/{}\n".format(name)
+    else:
+        data = sha + "\n"
+    lock = GitLockFile(repo_path(repo, "HEAD"))
+    try:
+        lock.write(data.encode("utf8"))
+        lock.commit("reference" in repo.fsync)
+    finally:
+        lock.rollback()
+    ref_store(repo).forget("HEAD")
+
+
+def checkout_pack_order(repo, sha):
+    """
+    loose objects first, then packed ones by pack and offset.
+    """
+    found = pack_find(repo, sha)
+    if not found:
+        return (-1, 0)
+    return (repo.packs.index(found[0]), found[1])
+
+
+def blob_checkout(repo, sha, dest):
+    """
+    to stream a blob into the file dest.
+    """
+    stream = object_stream(repo, sha)
+    if not stream:
+        raise Exception("Object {} is missing".format(sha))
+    with open(dest, "wb") as f:
+        for chunk in stream[2]:
+            f.write(chunk)
+
+
+class GitRefStore(object):
+    """
+    Loose refs and the packed-refs file, cached in-process and keyed on
+    their mtimes so that a ref is only re-read once its file changed.
+    """
+
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+        self.loose = dict()
+        self.packed_key = None
+        self.packed = dict()
+        self.peeled = dict()
+        self.names = list()
+
+    def packed_refs(self):
+        """
+        to get packed-refs as a dict, re-reading the file if it changed.
+        """
+        path = os.path.join(self.gitdir, "packed-refs")
+        try:
+            key = ref_stat_key(os.stat(path))
+        except FileNotFoundError:
+            key = None
+
+        if key != self.packed_key:
+            if key:
+                with open(path, "rb") as f:
+                    self.packed, self.peeled = packed_refs_parse(f.read())
+            else:
+                self.packed, self.peeled = dict(), dict()
+            self.names = sorted(self.packed)
+            self.packed_key = key
+        return self.packed
+
+    def read_loose(self, name):
+        """
+        to get the content of the loose ref name, or None.
+        """
+        path = os.path.join(self.gitdir, name)
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            self.loose.pop(name, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        key = ref_stat_key(st)
+        cached = self.loose.get(name)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, "r") as f:
+            data = f.read().strip()
+        self.loose[name] = (key, data)
+        return data
+
+    def read(self, name):
+        """
+        to get the content of the ref name, a loose ref hiding a packed one.
+        """
+        data = self.read_loose(name)
+        if data is None:
+            data = self.packed_refs().get(name)
+        return data
+
+    def loose_refs(self, prefix="refs/"):
+        """
+        to list the loose refs under prefix as sorted (name, content).
+        """
+        rtn = list()
+        top = os.path.join(self.gitdir, prefix)
+        for root, dirs, files in os.walk(top):
+            for f in files:
+                if f.endswith(".lock"):
+                    continue
+                name = os.path.relpath(os.path.join(root, f), self.gitdir)
+                name = name.replace(os.sep, "/")
+                data = self.read_loose(name)
+                if data:
+                    rtn.append((name, data))
+        rtn.sort()
+        return rtn
+
+    def refs(self, prefix="refs/"):
+        """
+        to list every ref under prefix as sorted (name, content).
+        """
+        refs = dict(self.loose_refs(prefix))
+        packed = self.packed_refs()
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[i]
+            if not name.startswith(prefix):
+                break
+            refs.setdefault(name, packed[name])
+        return sorted(refs.items())
+
+    def forget(self, name):
+        """
+        to drop name from the cache, after writing it.
+        """
+        self.loose.pop(name, None)
+
+
+def ref_stat_key(st):
+    """
+    what a cached ref file is keyed on: it changed if any of these did.
+    """
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def ref_store(repo):
+    """
+    to get the repository's ref store, loading it once.
+    """
+    if repo.refs is None:
+        repo.refs = GitRefStore(repo.gitdir)
+    return repo.refs
+
+
+def packed_refs_parse(raw):
+    """
+    to parse packed-refs into {name: sha} and {name: peeled sha}.
+    """
+    refs, peeled = dict(), dict()
+    name = None
+    for line in raw.splitlines():
+        if not line or line.startswith(b"#"):
+            continue
+        if line.startswith(b"^"):
+            if name:
+                peeled[name] = line[1:41].decode("ascii")
+            continue
+        sha, _, name = line.partition(b" ")
+        name = name.decode("utf8")
+        refs[name] = sha.decode("ascii")
+    return refs, peeled
+
+
+def ref_resolve(repo, ref):
+    """
+    To evaluate the ref name, following symbolic refs.
+    """
+    store = ref_store(repo)
+    for _ in range(5):
+        data = store.read(ref)
+        if not data or not data.startswith("ref:"):
+            return data
+        ref = data[4:].strip()
+    raise Exception("Too many levels of symbolic refs: {}".format(ref))
+
+
+def ref_list(repo, prefix="refs/"):
+    """
+    to collect refs under prefix and store them in a nested dict
+    """
+    rtn = collections.OrderedDict()
+    for name, data in ref_store(repo).refs(prefix):
+        sha = ref_resolve(repo, data[4:].strip()) if data.startswith("ref:") else data
+        if not sha:
+            continue
+        node = rtn
+        parts = name[len(prefix):].split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, collections.OrderedDict())
+        node[parts[-1]] = sha
+    return rtn
+
+
+ZERO_SHA = "0" * 40
+
+
+class GitLockFile(object):
+    """
+    path.lock, created exclusively so that only one writer holds it.
+    Committing renames it over path, rolling back removes it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            raise Exception("Unable to create {}.lock: it already exists.".format(path))
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def commit(self, fsync=False):
+        if fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.path + ".lock", self.path)
+
+    def rollback(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        os.remove(self.path + ".lock")
+
+
+class GitRefTransaction(object):
+    """
+    A batch of ref updates applied together. Every ref is locked and
+    checked against its expected old value before any of them changes.
+    Large batches go straight into packed-refs.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.updates = collections.OrderedDict()
+
+    def update(self, name, new, old=None):
+        """
+        to set name to new. old is the sha it must have now, ZERO_SHA
+        for a ref that must not exist, or None not to check.
+        """
+        name = ref_target(self.repo, name)
+        if not ref_name_valid(name):
+            raise Exception("Invalid ref name {}.".format(name))
+        if name in self.updates:
+            raise Exception("Multiple updates for ref {}.".format(name))
+        self.updates[name] = (new, old)
+
+    def create(self, name, new):
+        self.update(name, new, ZERO_SHA)
+
+    def delete(self, name, old=None):
+        self.update(name, ZERO_SHA, old)
+
+    def commit(self, packed=None):
+        """
+        to lock, verify and apply every update, or none of them.
+        """
+        repo = self.repo
+        store = ref_store(repo)
+        if packed is None:
+            threshold = repo.conf.getint("refs", "packthreshold", fallback=1000)
+            packed = len(self.updates) >= threshold
+
+        locks = list()
+        try:
+            for name in sorted(self.updates):
+                path = repo_path(repo, name)
+                if os.path.isdir(path):
+                    raise Exception("Ref {} is in the way of a directory.".format(name))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                locks.append((name, GitLockFile(path)))
+
+            current = store.packed_refs()
+            deletes = any(
+                new == ZERO_SHA and name in current
+                for name, (new, old) in self.updates.items()
+            )
+            if packed or deletes:
+                locks.append((None, GitLockFile(repo_path(repo, "packed-refs"))))
+                current = store.packed_refs()
+
+            # Only now that everything is locked are the old values stable.
+            for name, (new, old) in self.updates.items():
+                value = store.read(name) or ZERO_SHA
+                if old is not None and value != old:
+                    raise Exception(
+                        "Ref {} is at {} but expected {}.".format(name, value, old)
+                    )
+
+            if packed or deletes:
+                refs = dict(current)
+                for name, (new, old) in self.updates.items():
+                    if new == ZERO_SHA:
+                        refs.pop(name, None)
+                    elif packed:
+                        refs[name] = new
+                locks[-1][1].write(packed_refs_serialize(repo, refs))
+                locks[-1][1].commit("reference" in repo.fsync)
+
+            for name, lock in locks:
+                if name is None:
+                    continue
+                new = self.updates[name][0]
+                if new == ZERO_SHA or packed:
+                    ref_remove_loose(repo, name, lock)
+                else:
+                    lock.write((new + "\n").encode("ascii"))
+                    lock.commit("reference" in repo.fsync)
+                    store.forget(name)
+        finally:
+            for name, lock in locks:
+                lock.rollback()
+            refs_prune_dirs(repo, [name for name, lock in locks if name])
+        self.updates.clear()
+
+
+def ref_target(repo, name):
+    """
+    to follow symbolic refs from name to the ref that holds a sha.
+    """
+    store = ref_store(repo)
+    for _ in range(5):
+        data = store.read(name)
+        if not data or not data.startswith("ref:"):
+            return name
+        name = data[4:].strip()
+    raise Exception("Too many levels of symbolic refs: {}".format(name))
+
+
+def ref_name_valid(name):
+    """
+    whether name is one git would accept for a ref.
+    """
+    if name != "HEAD" and not name.startswith("refs/"):
+        return False
+    for part in name.split("/"):
+        if not part or part.startswith(".") or part.endswith(".lock"):
+            return False
+    return not (re.search(r"[\x00-\x20~^:?*\[\\\x7f]|\.\.|@\{", name) or name.endswith("."))
+
+
+argsp = argsubparsers.add_parser("show-ref", help="list references")
+
+
+def cmd_showref(args):
+    """
+    kickstrter to show ref
+    """
+
+    repo = repo_find()
+
+    refs = ref_list(repo)
+    show_ref(repo, refs, prefix="refs")
+
+
+def show_ref(repo, refs, with_hash=True, prefix=""):
+    """
+    The actual function to show refs
+    """
+    for k, v in refs.items():
+        if isinstance(v, str):
+            print(
+                "{}{}{}".format(
+                    v + " " if with_hash else "", prefix + "/" if prefix else "", k
+                )
+            )
+        else:
+            show_ref(
+                repo,
+                v,
+                with_hash=with_hash,
+                prefix="{}{}{}".format(prefix, "/" if prefix else "", k),
+            )
+
+
+argsp = argsubparsers.add_parser("pack-refs", help="Pack refs into packed-refs")
+argsp.add_argument(
+    "--all", action="store_true", dest="every", help="pack every ref, not only tags"
+)
+argsp.add_argument(
+    "--no-prune", action="store_false", dest="prune", help="keep the loose refs"
+)
+
+
+def cmd_packrefs(args):
+    """
+    kickstarter for pack-refs command.
+    """
+    repo = repo_find()
+    refs_pack(repo, every=args.every, prune=args.prune)
+
+
+def refs_pack(repo, every=False, prune=True):
+    """
+    to fold loose refs into packed-refs: tags and refs already packed,
+    or every ref. Symbolic refs stay loose.
+    """
+    store = ref_store(repo)
+    lock = GitLockFile(repo_path(repo, "packed-refs"))
+    try:
+        refs = dict(store.packed_refs())
+        loose = [
+            (name, data)
+            for name, data in store.loose_refs()
+            if not data.startswith("ref:")
+            and (every or name.startswith("refs/tags/") or name in refs)
+        ]
+        refs.update(loose)
+        lock.write(packed_refs_serialize(repo, refs))
+        lock.commit("reference" in repo.fsync)
+    finally:
+        lock.rollback()
+
+    if prune:
+        for name, data in loose:
+            # A ref being updated, or updated meanwhile, is newer than its
+            # packed value: it is only removed under its own lock, and
+            # only if it still holds what was packed.
+            try:
+                ref_lock = GitLockFile(repo_path(repo, name))
+            except Exception:
+                continue
+            if store.read_loose(name) == data:
+                ref_remove_loose(repo, name, ref_lock)
+            else:
+                ref_lock.rollback()
+        refs_prune_dirs(repo, [name for name, data in loose])
+
+
+def ref_remove_loose(repo, name, lock=None):
+    """
+    to delete the loose ref name, and then release its lock if held.
+    """
+    path = repo_path(repo, name)
+    if os.path.isfile(path):
+        os.remove(path)
+    ref_store(repo).forget(name)
+    if lock:
+        lock.rollback()
+
+
+def refs_prune_dirs(repo, names):
+    """
+    to remove the directories the refs names left empty, each once.
+    """
+    for path in sorted({os.path.dirname(repo_path(repo, n)) for n in names}, reverse=True):
+        dirs_prune(repo_path(repo, *os.path.relpath(path, repo.gitdir).split(os.sep)[:2]), path)
+
+
+def packed_refs_serialize(repo, refs):
+    """
+    to render refs as packed-refs, sorted and with annotated tags peeled.
+    """
+    store = ref_store(repo)
+    store.packed_refs()
+    lines = [b"# pack-refs with: peeled fully-peeled sorted \n"]
+    peels = dict()
+    for name in sorted(refs):
+        sha = refs[name]
+        lines.append("{} {}\n".format(sha, name).encode("utf8"))
+
+        if store.packed.get(name) == sha and name in store.peeled:
+            peeled = store.peeled[name]
+        elif sha in peels:
+            peeled = peels[sha]
+        else:
+            peeled = sha
+            while True:
+                header = object_read_header(repo, peeled)
+                if not header or header[0] != b"tag":
+                    break
+                peeled = object_read(repo, peeled).kvlm[b"object"].decode("ascii")
+            peels[sha] = peeled
+        if peeled != sha:
+            lines.append("^{}\n".format(peeled).encode("ascii"))
+    return b"".join(lines)
+
+
+argsp = argsubparsers.add_parser("update-ref", help="Update refs safely")
+argsp.add_argument("-d", action="store_true", dest="delete", help="delete the ref")
+argsp.add_argument(
+    "--stdin",
+    action="store_true",
+    help="read update, create and delete lines from stdin, applied in one transaction",
+)
+argsp.add_argument(
+    "--packed",
+    action="store_const",
+    const=True,
+    help="write the refs straight into packed-refs",
+)
+argsp.add_argument("ref", nargs="?", help="the ref to update")
+argsp.add_argument("new", nargs="?", help="its new value")
+argsp.add_argument("old", nargs="?", help="the value it must have now")
+
+
+def cmd_updateref(args):
+    """
+    kickstarter for update-ref command.
+    """
+    repo = repo_find()
+    tx = GitRefTransaction(repo)
+
+    if args.stdin:
+        for line in sys.stdin:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] in ("update", "create") and len(words) in (3, 4):
+                old = ZERO_SHA if words[0] == "create" else None
+                if len(words) == 4 and words[0] == "update":
+                    old = update_ref_value(repo, words[3])
+                tx.update(words[1], update_ref_value(repo, words[2]), old)
+            elif words[0] == "delete" and len(words) in (2, 3):
+                old = update_ref_value(repo, words[2]) if len(words) == 3 else None
+                tx.delete(words[1], old)
+            else:
+                raise Exception("Bad update-ref line: {}".format(line.strip()))
+    elif args.delete and args.ref and not args.old:
+        old = update_ref_value(repo, args.new) if args.new else None
+        tx.delete(args.ref, old)
+    elif args.ref and args.new and not args.delete:
+        old = update_ref_value(repo, args.old) if args.old else None
+        tx.update(args.ref, update_ref_value(repo, args.new), old)
+    else:
+        raise Exception("Usage: update-ref [-d] <ref> [<new>] [<old>] | --stdin")
+
+    tx.commit(packed=args.packed)
+
+
+def update_ref_value(repo, name):
+    """
+    to resolve a value given to update-ref; an empty or zero one means
+    the ref does not exist.
+    """
+    if not name.strip("0"):
+        return ZERO_SHA
+    return object_find(repo, name)
+
+
+class GitTag(GitCommit):
+    """
+    This will define the Git Tag class object.
+    """
+
+    fmt = b"tag"
+
+
+argsp = argsubparsers.add_parser("tag", help="List and create tags")
+argsp.add_argument(
+    "-a", action="store_true", dest="create_tag_object", help="to create a tag"
+)
+argsp.add_argument("name", nargs="?", help="tag's name")
+argsp.add_argument("object", default="HEAD", nargs="?", help="The object to point to")
+
+
+def cmd_tag(args):
+    """
+    kickstarter for tag command.
+    """
+    repo = repo_find()
+
+    if args.name:
+        tag_create(
+            repo,
+            args.name,
+            args.object,
+            create_tag_object=args.create_tag_object,
+        )
+    else:
+        refs = ref_list(repo, "refs/tags/")
+        show_ref(repo, refs, with_hash=False)
+
+
+def tag_create(repo, name, ref, create_tag_object=False):
+    """
+    To call when in need to create a tag object
+    """
+    sha = object_find(repo, ref)
+
+    if create_tag_object:
+        tag = GitTag()
+
+        tag.kvlm = collections.OrderedDict()
+        tag.kvlm[b"object"] = sha.encode()
+        tag.kvlm[b"type"] = object_read_header(repo, sha)[0]
+        tag.kvlm[b"tag"] = name.encode()
+        tag.kvlm[b"tagger"] = identity_stamp(gitconfig_user(repo), datetime.now())
+        tag.kvlm[None] = b"filler message when creating a tag.\n"
+        tag_sha = object_write(tag, repo)
+
+        ref_create(repo, "tags/" + name, tag_sha, ZERO_SHA)
+
+    else:
+        ref_create(repo, "tags/" + name, sha, ZERO_SHA)
+
+
+def ref_create(repo, ref_name, sha, old=None):
+    """
+    To create a ref, under its lock.
+    """
+    tx = GitRefTransaction(repo)
+    tx.update("refs/" + ref_name, sha, old)
+    tx.commit()
+
+
+argsp = argsubparsers.add_parser(
+    "repack", help="Pack all reachable objects into a single pack"
+)
+argsp.add_argument(
+    "-d", dest="delete", action="store_true", help="remove redundant packs and loose objects"
+)
+argsp.add_argument("--window", type=int, default=None, help="delta search window")
+argsp.add_argument("--depth", type=int, default=None, help="maximum delta depth")
+argsp.add_argument(
+    "-b",
+    "--write-bitmap-index",
+    dest="bitmaps",
+    action="store_true",
+    default=None,
+    help="also write a reachability bitmap next to the pack",
+)
+
+
+def cmd_repack(args):
+    """
+    kickstarter for repack command.
+    """
+    repo = repo_find()
+    repack(
+        repo,
+        window=args.window,
+        depth=args.depth,
+        delete=args.delete,
+        bitmaps=args.bitmaps,
+    )
+
+
+argsp = argsubparsers.add_parser("gc", help="Repack and prune the object store")
+
+
+def cmd_gc(args):
+    """
+    kickstarter for gc command.
+    """
+    repo = repo_find()
+    repack(repo, delete=True)
+
+
+def repo_tips(repo):
+    """
+    to collect HEAD and every ref as a list of shas.
+    """
+    tips = list()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+
+    stack = [ref_list(repo)]
+    while stack:
+        for v in stack.pop().values():
+            if isinstance(v, str):
+                tips.append(v)
+            elif v:
+                stack.append(v)
+    return tips
+
+
+def object_walk(repo, shas):
+    """
+    to list every object reachable from shas as (sha, fmt, size, name),
+    where name is the path the object was last seen at.
+    """
+    seen = set()
+    stack = [(sha, b"", False) for sha in shas]
+    while stack:
+        sha, name, blob = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        # Blobs are never parsed, their header is enough.
+        if blob:
+            header = object_read_header(repo, sha)
+            if not header:
+                raise Exception("Object {} is missing".format(sha))
+            yield sha, header[0], header[1], name
+            continue
+
+        raw = object_read_raw(repo, sha)
+        if not raw:
+            raise Exception("Object {} is missing".format(sha))
+        fmt, data = raw
+        yield sha, fmt, len(data), name
+
+        match fmt:
+            case b"commit":
+                obj = GitCommit(data)
+                for p in obj.parents:
+                    stack.append((p, b"", False))
+                stack.append((obj.tree, b"", False))
+            case b"tag":
+                obj = GitTag(data)
+                stack.append((obj.kvlm[b"object"].decode("ascii"), b"", False))
+            case b"tree":
+                for item in tree_parse(data):
+                    # Submodule commits live in another repository.
+                    if item.mode != b"160000":
+                        stack.append((item.sha, item.name, not item.is_tree()))
+
+
+def repack(repo, window=None, depth=None, delete=False, bitmaps=None):
+    """
+    to write every object reachable from the refs or the index into one
+    new pack. With delete, the old packs and the packed loose objects are
+    removed; objects of the old packs the new one lacks are kept, loose.
+    With bitmaps (repack.writeBitmaps by default), the pack gets a
+    reachability bitmap.
+    """
+    if window is None:
+        window = repo.conf.getint("pack", "window", fallback=10)
+    if depth is None:
+        depth = repo.conf.getint("pack", "depth", fallback=50)
+    if bitmaps is None:
+        bitmaps = repo.conf.getboolean("repack", "writebitmaps", fallback=False)
+
+    objects = list(object_walk(repo, repo_tips(repo) + index_tips(repo)))
+    if not objects:
+        return None
+
+    old = list(repo_packs(repo))
+    idx = pack_write(repo, objects, window=window, depth=depth)
+    if bitmaps:
+        bitmap_write(repo, idx, objects)
+    repo.packs = None
+    repo.bitmap = None
+
+    if delete:
+        packed = {o[0] for o in objects}
+        for pack in old:
+            if pack.idxpath == idx:
+                continue
+            # Like git gc, unreachable objects are not lost but loosened.
+            for i in range(pack.count):
+                sha = pack.sha(i).hex()
+                if sha not in packed:
+                    object_loosen(repo, sha)
+            for path in (pack.idxpath, pack.packpath):
+                os.remove(path)
+            bitmap = pack.idxpath[:-4] + ".bitmap"
+            if os.path.exists(bitmap):
+                os.remove(bitmap)
+        prune_packed(repo, (o[0] for o in objects))
+    return idx
+
+
+def index_tips(repo):
+    """
+    the shas the index refers to: its entries, and its cached trees that
+    are still valid. Staged objects may be reachable from nothing else.
+    """
+    index = index_read(repo)
+    shas = [e.sha for e in index.entries if e.mode != 0o160000]
+    stack = [index.cache_tree] if index.cache_tree else []
+    while stack:
+        node = stack.pop()
+        if node.entry_count >= 0:
+            shas.append(node.sha)
+        stack.extend(node.subtrees.values())
+    return shas
+
+
+def object_loosen(repo, sha):
+    """
+    to write a copy of an object as a loose file, even if a pack has it.
+    """
+    path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+    if os.path.exists(path):
+        return
+    fmt, data = object_read_raw(repo, sha)
+    header = fmt + b" " + str(len(data)).encode() + b"\x00"
+    tmp = object_write_temp(repo, (header, data), os.path.dirname(path))
+    object_write_rename(tmp, path)
+
+
+def prune_packed(repo, shas):
+    """
+    to remove the loose copies of packed objects.
+    """
+    dirs = set()
+    for sha in shas:
+        path = repo_path(repo, "objects", sha[0:2], sha[2:])
+        if os.path.isfile(path):
+            os.remove(path)
+            dirs.add(os.path.dirname(path))
+    for path in dirs:
+        if not os.listdir(path):
+            os.rmdir(path)
+
+
+# Reachability bitmaps, in git's .bitmap version 1 format. Their bitsets
+# are Python ints over the pack's objects in pack (offset) order.
+BITMAP_FULL_DAG = 0x1
+BITMAP_HASH_CACHE = 0x4
+BITMAP_SPACING = 100
+BITMAP_XOR_WINDOW = 10
+BITMAP_TYPES = (b"commit", b"tree", b"blob", b"tag")
+EWAH_ONES = 0xFFFFFFFFFFFFFFFF
+
+
+def ewah_encode(bits):
+    """
+    to serialize the bitset bits as an EWAH bitmap: 64-bit words where
+    runs of empty or full words fold into one run-length word, the way
+    git writes them.
+    """
+    size = bits.bit_length()
+    n = (size + 63) // 64
+    words = struct.unpack("<{}Q".format(n), bits.to_bytes(8 * n, "little"))
+
+    # A run-length word holds the run's bit, then the length of the run
+    # (32 bits), then the number of literal words after it (31 bits).
+    out = list()
+    rlw = i = 0
+    while i < n or not out:
+        rlw = len(out)
+        out.append(0)
+        fill = run = lits = 0
+        if i < n and words[i] in (0, EWAH_ONES):
+            fill = words[i]
+            while i < n and words[i] == fill and run < 0xFFFFFFFF:
+                run += 1
+                i += 1
+        while i < n and words[i] not in (0, EWAH_ONES) and lits < 0x7FFFFFFF:
+            out.append(words[i])
+            lits += 1
+            i += 1
+        out[rlw] = (fill & 1) | (run << 1) | (lits << 33)
+
+    return (
+        struct.pack(">II", size, len(out))
+        + struct.pack(">{}Q".format(len(out)), *out)
+        + struct.pack(">I", rlw)
+    )
+
+
+def ewah_decode(buf, pos):
+    """
+    to read the EWAH bitmap at pos in buf, as (bitset, end offset).
+    """
+    size, count = struct.unpack_from(">II", buf, pos)
+    words = struct.unpack_from(">{}Q".format(count), buf, pos + 8)
+    out = list()
+    i = 0
+    while i < count:
+        rlw = words[i]
+        lits = rlw >> 33
+        out.extend([EWAH_ONES if rlw & 1 else 0] * ((rlw >> 1) & 0xFFFFFFFF))
+        out.extend(words[i + 1 : i + 1 + lits])
+        i += 1 + lits
+    bits = int.from_bytes(struct.pack("<{}Q".format(len(out)), *out), "little")
+    return bits & ((1 << size) - 1), pos + 12 + 8 * count
+
+
+def bitset_positions(bits):
+    """
+    to yield the positions of the set bits of bits, lowest first.
+    """
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(raw):
+        while byte:
+            low = byte & -byte
+            yield 8 * i + low.bit_length() - 1
+            byte ^= low
+
+
+class GitBitmap(object):
+    """
+    A pack's .bitmap: for some commits, every object of the pack they
+    reach, plus the commits, trees, blobs and tags of the pack.
+    """
+
+    def __init__(self, pack):
+        self.path = pack.idxpath[:-4] + ".bitmap"
+        self.pack = pack
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        version, flags, count = struct.unpack_from(">HHI", data, 4)
+        if data[0:4] != b"BITM" or version != 1:
+            raise Exception("Unsupported bitmap {}".format(self.path))
+        if not flags & BITMAP_FULL_DAG or data[12:32] != pack.pack[-20:]:
+            raise Exception("Malformed bitmap {}".format(self.path))
+
+        pos = 32
+        self.types = dict()
+        for fmt in BITMAP_TYPES:
+            self.types[fmt], pos = ewah_decode(data, pos)
+
+        # Entries are only indexed here; their bitmaps are read on demand.
+        # One may be stored XORed with an entry up to 160 before it.
+        self.entries = dict()
+        self.offsets = list()
+        for i in range(count):
+            idxpos, xor, _ = struct.unpack_from(">IBB", data, pos)
+            self.entries[pack.sha(idxpos).hex()] = i
+            self.offsets.append((pos + 6, xor))
+            (words,) = struct.unpack_from(">I", data, pos + 10)
+            pos += 6 + 12 + 8 * words
+
+        self.bitmaps = dict()
+        self._order = None
+        self._positions = None
+
+    def order(self):
+        """
+        the index positions of the pack's objects in pack order, and the
+        pack order of each index position.
+        """
+        if self._order is None:
+            pack = self.pack
+            self._order = sorted(range(pack.count), key=pack.offset)
+            self._positions = [0] * pack.count
+            for bit, i in enumerate(self._order):
+                self._positions[i] = bit
+        return self._order, self._positions
+
+    def position(self, sha):
+        """
+        the bit of sha, or None when it is not in the pack.
+        """
+        i = self.pack.find(bytes.fromhex(sha))
+        return None if i is None else self.order()[1][i]
+
+    def sha(self, bit):
+        return self.pack.sha(self.order()[0][bit]).hex()
+
+    def bitmap(self, sha):
+        """
+        everything the commit sha reaches, or None if it has no bitmap.
+        """
+        i = self.entries.get(sha)
+        return None if i is None else self.entry(i)
+
+    def entry(self, i):
+        if i not in self.bitmaps:
+            pos, xor = self.offsets[i]
+            bits = ewah_decode(self.data, pos)[0]
+            if xor:
+                bits ^= self.entry(i - xor)
+            self.bitmaps[i] = bits
+        return self.bitmaps[i]
+
+
+def repo_bitmap(repo):
+    """
+    to load, once, the bitmap of the first pack that has one, unless
+    pack.useBitmaps is false.
+    """
+    if repo.bitmap is None:
+        repo.bitmap = False
+        if repo.conf.getboolean("pack", "usebitmaps", fallback=True):
+            for pack in repo_packs(repo):
+                if os.path.exists(pack.idxpath[:-4] + ".bitmap"):
+                    repo.bitmap = GitBitmap(pack)
+                    break
+    return repo.bitmap
+
+
+def bitmap_reach(repo, shas, position, lookup, objects=True):
+    """
+    to find what shas reach, as a bitset over the pack (position gives
+    the bit of a sha, or None) and a dict of the objects outside of it
+    with their type. The walk stops at every commit lookup has a bitmap
+    for, which brings in all it reaches at once. Without objects, trees
+    and blobs are only what those bitmaps bring.
+    """
+    bits = 0
+    have = b""
+    walked = set()
+    extra = dict()
+    stack = [(sha, None) for sha in shas]
+    while stack:
+        sha, fmt = stack.pop()
+        pos = position(sha)
+        if pos is None:
+            if sha in extra:
+                continue
+        elif pos in walked:
+            continue
+        elif pos >> 3 < len(have) and have[pos >> 3] >> (pos & 7) & 1:
+            continue
+
+        if fmt is None:
+            fmt = object_read_header(repo, sha)[0]
+        if fmt == b"commit":
+            found = lookup(sha)
+            if found is not None:
+                bits |= found
+                have = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+                continue
+
+        if pos is None:
+            extra[sha] = fmt
+        else:
+            walked.add(pos)
+
+        match fmt:
+            case b"commit":
+                stack.extend((p, b"commit") for p in commit_info(repo, sha)[0])
+                if objects:
+                    stack.append((commit_tree(repo, sha), b"tree"))
+            case b"tree":
+                for item in object_read(repo, sha).items:
+                    # Submodule commits live in another repository.
+                    if item.mode != b"160000":
+                        stack.append((item.sha, b"tree" if item.is_tree() else b"blob"))
+            case b"tag":
+                target = object_read(repo, sha).kvlm[b"object"].decode("ascii")
+                stack.append((target, None))
+
+    if walked:
+        raw = bytearray(max(walked) // 8 + 1)
+        for pos in walked:
+            raw[pos >> 3] |= 1 << (pos & 7)
+        bits |= int.from_bytes(raw, "little")
+    return bits, extra
+
+
+def bitmap_write(repo, idx, objects):
+    """
+    to write the .bitmap of the pack idx, which holds objects, a list of
+    (sha, fmt, size, name) closed under reachability. The ref tips and
+    one commit in BITMAP_SPACING of their history get a bitmap; each is
+    stored XORed with the one of the last few that makes it smallest.
+    """
+    pack = GitPack(idx)
+    order = sorted(range(pack.count), key=pack.offset)
+    positions = {pack.sha(i).hex(): bit for bit, i in enumerate(order)}
+    info = {sha: (fmt, name) for sha, fmt, _, name in objects}
+
+    types = {fmt: bytearray(pack.count // 8 + 1) for fmt in BITMAP_TYPES}
+    for sha, bit in positions.items():
+        types[info[sha][0]][bit >> 3] |= 1 << (bit & 7)
+
+    # Selected commits are done oldest first, so each walk stops at the
+    # bitmaps of the selected commits below it.
+    tips = [commit_peel(repo, sha) for sha in repo_tips(repo)]
+    history = list(rev_walk(repo, list(dict.fromkeys(t for t in tips if t))))
+    selected = set(tips) | set(history[::BITMAP_SPACING])
+    bitmaps = dict()
+    for sha in reversed(history):
+        if sha in selected:
+            bits, extra = bitmap_reach(repo, [sha], positions.get, bitmaps.get)
+            if extra:
+                raise Exception("Pack {} is missing reachable objects".format(idx))
+            bitmaps[sha] = bits
+
+    out = bytearray(b"BITM")
+    out += struct.pack(">HHI", 1, BITMAP_FULL_DAG | BITMAP_HASH_CACHE, len(bitmaps))
+    out += pack.pack[-20:]
+    for fmt in BITMAP_TYPES:
+        out += ewah_encode(int.from_bytes(types[fmt], "little"))
+
+    written = list()
+    for sha, bits in bitmaps.items():
+        xor, best = 0, ewah_encode(bits)
+        for back in range(1, min(BITMAP_XOR_WINDOW, len(written)) + 1):
+            candidate = ewah_encode(bits ^ written[-back])
+            if len(candidate) < len(best):
+                xor, best = back, candidate
+        out += struct.pack(">IBB", pack.find(bytes.fromhex(sha)), xor, 0)
+        out += best
+        written.append(bits)
+
+    hashes = [pack_name_hash(info[pack.sha(i).hex()][1]) for i in order]
+    out += struct.pack(">{}I".format(len(hashes)), *hashes)
+    out += hashlib.sha1(out).digest()
+
+    lock = GitLockFile(idx[:-4] + ".bitmap")
+    try:
+        lock.write(out)
+        lock.commit("pack-metadata" in repo.fsync)
+    finally:
+        lock.rollback()
+
+
+class GitIndexEntry(object):
+    """
+    This defines an index entry: a staged file, its sha and the stat data
+    used to tell whether the worktree file may have changed.
+    """
+
+    __slots__ = (
+        "ctime",
+        "mtime",
+        "dev",
+        "ino",
+        "mode",
+        "uid",
+        "gid",
+        "size",
+        "sha",
+        "flags",
+        "extended",
+        "name",
+    )
+
+    def __init__(
+        self,
+        ctime=(0, 0),
+        mtime=(0, 0),
+        dev=0,
+        ino=0,
+        mode=0o100644,
+        uid=0,
+        gid=0,
+        size=0,
+        sha=None,
+        flags=0,
+        extended=0,
+        name=None,
+    ):
+        self.ctime = ctime
+        self.mtime = mtime
+        self.dev = dev
+        self.ino = ino
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.sha = sha
+        self.flags = flags
+        self.extended = extended
+        self.name = name
+
+    @property
+    def stage(self):
+        return (self.flags >> 12) & 3
+
+
+class GitIndex(object):
+    """
+    This defines the index (staging area): sorted entries plus the raw
+    content of its extensions.
+    """
+
+    def __init__(self, version=2, entries=None, extensions=None):
+        self.version = version
+        self.entries = entries if entries is not None else list()
+        self.extensions = (
+            extensions if extensions is not None else collections.OrderedDict()
+        )
+        # The index file mtime, to spot racily clean entries.
+        self.mtime = None
+        self.cache_tree = None
+        self.untracked = None
+
+    def invalidate(self, name):
+        """
+        to drop what the change of the entry name makes stale.
+        """
+        if self.cache_tree:
+            self.cache_tree.invalidate(name)
+        if self.untracked:
+            self.untracked.invalidate(name)
+        self.extensions.pop(b"UNTR", None)
+
+
+class GitCacheTree(object):
+    """
+    This defines a node of the cached-tree (TREE) index extension: the sha
+    of the tree built for a directory, and how many index entries it
+    covers; an entry_count of -1 means the directory changed since.
+    """
+
+    __slots__ = ("entry_count", "sha", "subtrees")
 
+    def __init__(self, entry_count=-1, sha=None):
+        self.entry_count = entry_count
+        self.sha = sha
+        self.subtrees = collections.OrderedDict()
+
+    def invalidate(self, name):
+        """
+        to invalidate every directory on the path of the entry name.
+        """
+        node = self
+        parts = name.split("/")
+        for part in parts[:-1]:
+            node.entry_count = -1
+            node = node.subtrees.get(part)
+            if node is None:
+                return
+        node.entry_count = -1
+
+
+def cache_tree_parse(data):
+    """
+    to parse the TREE extension, whose nodes are stored in pre-order.
+    """
+    pos = 0
 
-def TreeLeaf_SortKey(leaf):
+    def node():
+        nonlocal pos
+        nul = data.index(b"\x00", pos)
+        name = data[pos:nul].decode("utf8")
+        nl = data.index(b"\n", nul)
+        count, subtrees = data[nul + 1 : nl].split(b" ")
+        pos = nl + 1
+        tree = GitCacheTree(int(count))
+        if tree.entry_count >= 0:
+            tree.sha = data[pos : pos + 20].hex()
+            pos += 20
+        for _ in range(int(subtrees)):
+            child_name, child = node()
+            tree.subtrees[child_name] = child
+        return name, tree
+
+    return node()[1]
+
+
+def cache_tree_serialize(tree):
     """
-    this is an edit due some problems with sorting in python3
+    to write the TREE extension back.
     """
-    if leaf.mode.startwith(b"10"):
-        return leaf.path
-    else:
-        return leaf.path + "/"
+    parts = list()
+    stack = [("", tree)]
+    while stack:
+        name, node = stack.pop()
+        parts.append(name.encode("utf8"))
+        parts.append(b"\x00%d %d\n" % (node.entry_count, len(node.subtrees)))
+        if node.entry_count >= 0:
+            parts.append(bytes.fromhex(node.sha))
+        stack.extend(reversed(node.subtrees.items()))
+    return b"".join(parts)
 
 
-def tree_serialize(obj):
+INDEX_UNTRACKED = b"GIPU"
+
+
+class GitUntrackedCache(object):
     """
-    to serialize and turn object to sha.
+    This defines our own untracked cache index extension. git skips
+    unknown extensions whose signature is uppercase, and drops them when
+    it rewrites the index, so it never sees a stale one.
+    For every directory status listed it keeps its mtime, the stat data
+    of its .gitignore, and the untracked files and subdirectories found;
+    all of it is only valid under the same global ignore rules.
     """
 
-    obj.items.sort(key=TreeLeaf_SortKey)
-    rtn = b""
-    for i in obj.items:
-        rtn += i.mode
-        rtn += b" "
-        rtn += i.path.encode("utf8")
-        rtn += b"\x00"
-        sha = int(i.sha, 16)
-        rtn += sha.to_bytes(20, byteorder="big")
-    return rtn
+    def __init__(self, excludes=None, dirs=None):
+        self.excludes = excludes
+        self.dirs = dirs if dirs is not None else dict()
+        self.changed = False
 
+    def invalidate(self, name):
+        """
+        to forget the directory of the entry name, whose files may have
+        become tracked or untracked.
+        """
+        if self.dirs.pop(name.rpartition("/")[0], None) is not None:
+            self.changed = True
 
-class GitTree(GitObject):
+
+def untracked_cache_parse(data):
     """
-    defines a git tree object.
+    to parse the untracked cache: the global ignore rules fingerprint,
+    then per directory its name, mtime, .gitignore mtime and size,
+    and its untracked files and subdirectories.
     """
+    cache = GitUntrackedCache(data[:20])
+    pos = 20
+    while pos < len(data):
+        nul = data.index(b"\x00", pos)
+        name = data[pos:nul].decode("utf8")
+        mtime, ignore_mtime, ignore_size, nfiles, ndirs = struct.unpack_from(">3Q2I", data, nul + 1)
+        pos = nul + 1 + 32
+        names = list()
+        for _ in range(nfiles + ndirs):
+            nul = data.index(b"\x00", pos)
+            names.append(data[pos:nul].decode("utf8"))
+            pos = nul + 1
+        cache.dirs[name] = (mtime, (ignore_mtime, ignore_size), names[:nfiles], names[nfiles:])
+    return cache
+
+
+def untracked_cache_serialize(cache):
+    """
+    to write the untracked cache back.
+    """
+    parts = [cache.excludes]
+    for name in sorted(cache.dirs):
+        mtime, ignore, files, dirs = cache.dirs[name]
+        parts.append(name.encode("utf8") + b"\x00")
+        parts.append(struct.pack(">3Q2I", mtime, ignore[0], ignore[1], len(files), len(dirs)))
+        for f in itertools.chain(files, dirs):
+            parts.append(f.encode("utf8") + b"\x00")
+    return b"".join(parts)
 
-    fmt = b"tree"
 
-    def deserialize(self, data):
-        self.items = tree_parse(data)
+INDEX_EXTENDED = 0x4000
+INDEX_NAME_MASK = 0xFFF
 
-    def serialize(self):
-        return tree_serialize(self)
 
-    def init(self):
-        self.items = list()
+def index_read(repo):
+    """
+    to read .git/index, versions 2 to 4; an empty index if there is none.
+    """
+    path = repo_file(repo, "index")
+    if not os.path.exists(path):
+        return GitIndex()
+
+    with open(path, "rb") as f:
+        raw = f.read()
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+
+    if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+        raise Exception("Bad index checksum")
+    signature, version, count = struct.unpack_from(">4sII", raw, 0)
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise Exception("Unsupported index version {}".format(version))
+
+    entries = list()
+    pos = 12
+    previous = b""
+    for _ in range(count):
+        start = pos
+        fields = struct.unpack_from(">10I20sH", raw, pos)
+        flags = fields[11]
+        pos += 62
+        extended = 0
+        if flags & INDEX_EXTENDED:
+            (extended,) = struct.unpack_from(">H", raw, pos)
+            pos += 2
+
+        if version == 4:
+            # The name is a suffix of the previous one, minus n bytes.
+            c = raw[pos]
+            pos += 1
+            strip = c & 0x7F
+            while c & 0x80:
+                c = raw[pos]
+                pos += 1
+                strip = ((strip + 1) << 7) | (c & 0x7F)
+            end = raw.index(b"\x00", pos)
+            name = previous[: len(previous) - strip] + raw[pos:end]
+            pos = end + 1
+        else:
+            end = raw.index(b"\x00", pos)
+            name = raw[pos:end]
+            # Entries are padded with 1 to 8 NULs to a multiple of 8.
+            pos = start + ((end - start) // 8 + 1) * 8
+        previous = name
+
+        entries.append(
+            GitIndexEntry(
+                ctime=(fields[0], fields[1]),
+                mtime=(fields[2], fields[3]),
+                dev=fields[4],
+                ino=fields[5],
+                mode=fields[6],
+                uid=fields[7],
+                gid=fields[8],
+                size=fields[9],
+                sha=fields[10].hex(),
+                flags=flags,
+                extended=extended,
+                name=name.decode("utf8"),
+            )
+        )
 
+    extensions = collections.OrderedDict()
+    end = len(raw) - 20
+    while pos < end:
+        signature, size = struct.unpack_from(">4sI", raw, pos)
+        if not b"A"[0] <= signature[0] <= b"Z"[0]:
+            raise Exception("Unsupported index extension {}".format(signature))
+        extensions[signature] = raw[pos + 8 : pos + 8 + size]
+        pos += 8 + size
+
+    index = GitIndex(version, entries, extensions)
+    index.mtime = mtime
+    if b"TREE" in extensions:
+        index.cache_tree = cache_tree_parse(extensions.pop(b"TREE"))
+    if INDEX_UNTRACKED in extensions:
+        index.untracked = untracked_cache_parse(extensions.pop(INDEX_UNTRACKED))
+    return index
+
+
+def index_lock(repo):
+    """
+    to take index.lock. Whoever changes the index takes it before reading
+    the index and keeps it until index_write renames it into place.
+    """
+    return GitLockFile(repo_file(repo, "index"))
 
-argsp = argsubparsers.add_parser(
-    "checkout", help="checkout a commit inside of a directory"
-)
-argsp.add_argument("commit", help="The commit to checkout")
-argsp.add_argument("path", help="the empty directory to checkout on")
 
+def index_write(repo, index, lock):
+    """
+    to write the index through lock, the held index.lock, in its own
+    version (v3 at least when an entry has extended flags).
+    """
+    version = index.version
+    if version == 2 and any(e.extended for e in index.entries):
+        version = 3
+
+    index.entries.sort(key=lambda e: (e.name.encode("utf8"), e.stage))
+    out = bytearray(struct.pack(">4sII", b"DIRC", version, len(index.entries)))
+    previous = b""
+    for e in index.entries:
+        name = e.name.encode("utf8")
+        flags = (e.flags & ~(INDEX_NAME_MASK | INDEX_EXTENDED)) | min(
+            len(name), INDEX_NAME_MASK
+        )
+        if e.extended:
+            flags |= INDEX_EXTENDED
+
+        start = len(out)
+        out += struct.pack(
+            ">10I20sH",
+            e.ctime[0] & 0xFFFFFFFF,
+            e.ctime[1],
+            e.mtime[0] & 0xFFFFFFFF,
+            e.mtime[1],
+            e.dev & 0xFFFFFFFF,
+            e.ino & 0xFFFFFFFF,
+            e.mode,
+            e.uid & 0xFFFFFFFF,
+            e.gid & 0xFFFFFFFF,
+            e.size & 0xFFFFFFFF,
+            bytes.fromhex(e.sha),
+            flags,
+        )
+        if e.extended:
+            out += struct.pack(">H", e.extended)
 
-def cmd_checkout(args):
+        if version == 4:
+            common = len(os.path.commonprefix([previous, name]))
+            out += pack_ofs_encode(len(previous) - common)
+            out += name[common:] + b"\x00"
+        else:
+            out += name
+            out += b"\x00" * (8 - (len(out) - start) % 8)
+        previous = name
+
+    extensions = list(index.extensions.items())
+    if index.cache_tree:
+        extensions.insert(0, (b"TREE", cache_tree_serialize(index.cache_tree)))
+    if index.untracked:
+        extensions.append((INDEX_UNTRACKED, untracked_cache_serialize(index.untracked)))
+        index.untracked.changed = False
+    for signature, data in extensions:
+        out += struct.pack(">4sI", signature, len(data))
+        out += data
+    out += hashlib.sha1(out).digest()
+
+    lock.write(out)
+    lock.commit("index" in repo.fsync)
+    index.mtime = os.stat(lock.path).st_mtime_ns
+
+
+def index_entry_stat(entry, st):
     """
-    a kickstarter function
+    to copy the stat data of a worktree file into its entry.
     """
-    repo = repo_find()
-    obj = object_read(repo, object_find(repo, args.commit))
+    entry.ctime = (int(st.st_ctime), st.st_ctime_ns % 1000000000)
+    entry.mtime = (int(st.st_mtime), st.st_mtime_ns % 1000000000)
+    entry.dev = st.st_dev
+    entry.ino = st.st_ino
+    entry.uid = st.st_uid
+    entry.gid = st.st_gid
+    entry.size = st.st_size
+    entry.mode = index_stat_mode(st)
+
 
-    if not obj:
-        raise Exception("No object was found")
+def index_stat_mode(st):
+    """
+    the mode git records for a worktree file with stat data st.
+    """
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    return 0o100755 if st.st_mode & 0o100 else 0o100644
 
-    if obj.fmt == b"commit":
-        obj = object_read(repo, obj.kvlm[b"tree"].decode("ascii"))
 
-    if os.os.path.exists(args.path):
-        if not os.path.isdir(args.path):
-            raise Exception("Not a directory: {}".format(args.path))
-        if os.listdir(args.path):
-            raise Exception("Not empty: {}".format(args.path))
-    else:
-        os.makedirs(args.path)
+def index_entry_clean(index, entry, st):
+    """
+    to tell, from stat data alone, that a worktree file did not change.
+    A file modified in the same tick the index was written could still
+    have the old stat data, so such racily clean entries are not trusted.
+    """
+    if (
+        entry.mtime != (int(st.st_mtime), st.st_mtime_ns % 1000000000)
+        or entry.ctime != (int(st.st_ctime), st.st_ctime_ns % 1000000000)
+        or entry.size != st.st_size & 0xFFFFFFFF
+        or entry.ino != st.st_ino & 0xFFFFFFFF
+        or entry.dev != st.st_dev & 0xFFFFFFFF
+    ):
+        return False
+    mtime = entry.mtime[0] * 1000000000 + entry.mtime[1]
+    return index.mtime is None or mtime < index.mtime
+
+
+def worktree_hash(repo, path, st, write=False):
+    """
+    to hash a worktree file, or the target of a symlink, as a blob.
+    """
+    if stat.S_ISLNK(st.st_mode):
+        return object_write(GitBlob(os.readlink(path).encode("utf8")), repo if write else None)
+    with open(path, "rb") as f:
+        return object_hash(f, b"blob", repo if write else None)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
 
+HASH_BATCH = 32
+HASH_PARALLEL_MIN = 64
 
-def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
 
-        if obj.fmt == b"tree":
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b"blob":
-            with open(dest, "wb") as f:
-                f.write(obj.blobdata)
+def worktree_hash_many(repo, names, write=False, jobs=None):
+    """
+    to hash many worktree files, returning their shas in the same order.
+    When there are enough of them, batches of files are hashed (and
+    written) on a process pool, each file in streamed chunks.
+    """
+    if jobs is None:
+        jobs = repo.conf.getint("core", "hashworkers", fallback=0) or os.cpu_count() or 1
+
+    if jobs <= 1 or len(names) < HASH_PARALLEL_MIN:
+        return worktree_hash_batch(repo.worktree, names, write, repo)
+
+    batches = [names[i : i + HASH_BATCH] for i in range(0, len(names), HASH_BATCH)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        if not (write and repo.bulk):
+            results = pool.map(
+                worktree_hash_batch,
+                itertools.repeat(repo.worktree),
+                batches,
+                itertools.repeat(write),
+            )
+            return [sha for batch in results for sha in batch]
+
+        # Each worker streams its batch into a pack segment of its own,
+        # which this process then moves into the bulk checkin pack.
+        futures = [pool.submit(worktree_hash_bulk, repo.worktree, b) for b in batches]
+        shas = list()
+        try:
+            for future in futures:
+                batch, path, entries = future.result()
+                repo.bulk.absorb(path, entries)
+                shas.extend(batch)
+        finally:
+            for future in futures:
+                if not future.cancel() and not future.exception():
+                    path = future.result()[1]
+                    if os.path.exists(path):
+                        os.remove(path)
+        return shas
+
+
+def worktree_hash_batch(worktree, names, write, repo=None):
+    """
+    to hash a batch of worktree files; runs in the pool workers.
+    """
+    repo = repo or GitRepo(worktree)
+    shas = list()
+    for name in names:
+        full = os.path.join(worktree, name)
+        shas.append(worktree_hash(repo, full, os.lstat(full), write))
+    return shas
 
 
-def ref_resolve(repo, ref):
+def worktree_hash_bulk(worktree, names):
+    """
+    to hash and write a batch of worktree files into a pack segment of
+    their own; runs in the pool workers. Returns the shas, the segment's
+    path and its (binsha, crc32, offset) entries.
+    """
+    repo = GitRepo(worktree)
+    bulk = GitBulkCheckin(repo)
+    try:
+        shas = worktree_hash_batch(worktree, names, True, repo)
+        bulk.f.close()
+    except BaseException:
+        bulk.rollback()
+        raise
+    return shas, bulk.tmp, bulk.entries
+
+
+def worktree_files(repo, root=None, ignore=None):
+    """
+    to list the files under root, relative to the worktree, without .git.
+    With ignore, ignored files are left out and ignored directories are
+    not even entered.
+    """
+    root = root or repo.worktree
+    for dirpath, dirnames, filenames in os.walk(root):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        rel = os.path.relpath(dirpath, repo.worktree)
+        rel = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+        if ignore:
+            dirnames[:] = [d for d in dirnames if not ignore.ignored(rel + d, True)]
+            filenames = [f for f in filenames if not ignore.ignored(rel + f, False)]
+        dirnames.sort()
+        for f in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, f), repo.worktree)
+
+
+def worktree_path(repo, path):
+    """
+    to turn a command line path into one relative to the worktree.
+    """
+    full = os.path.realpath(path)
+    if os.path.islink(path):
+        full = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+    rel = os.path.relpath(full, os.path.realpath(repo.worktree))
+    if rel == ".":
+        return ""
+    if rel.startswith(".." + os.sep) or rel == "..":
+        raise Exception("{} is outside repository".format(path))
+    return rel
+
+
+class GitIgnoreRules(object):
     """
-    To evaluate the ref name.
+    The patterns of one ignore file, relative to the directory base.
+    They are compiled into one regex for files and one for directories,
+    alternatives in reverse order so that the last matching rule wins.
     """
-    path = repo_file(repo, ref)
 
-    if not os.path.isfile(path):
+    def __init__(self, source, base, lines, icase=False):
+        self.source = source
+        self.base = base
+        self.rules = list()
+        for lineno, line in enumerate(lines, 1):
+            rule = gitignore_parse(line)
+            if rule:
+                self.rules.append((lineno,) + rule)
+
+        flags = re.IGNORECASE if icase else 0
+        rules = list(enumerate(self.rules))
+        self.file_re = gitignore_compile([r for r in rules if not r[1][3]], flags)
+        self.dir_re = gitignore_compile(rules, flags)
+
+    def match(self, path, is_dir):
+        """
+        to find the rule deciding path, relative to base, as
+        (source, lineno, pattern, negated), or None.
+        """
+        regex = self.dir_re if is_dir else self.file_re
+        m = regex.fullmatch(path) if regex else None
+        if not m:
+            return None
+        lineno, pattern, negated = self.rules[int(m.lastgroup[1:])][:3]
+        return (self.source, lineno, pattern, negated)
+
+
+def gitignore_parse(line):
+    """
+    to parse a line of an ignore file into
+    (pattern, negated, dir_only, regex), or None for blanks and comments.
+    """
+    line = line.rstrip("\r\n")
+    if not line or line.startswith("#"):
+        return None
+    # Trailing spaces are dropped, unless escaped.
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    pattern = line = stripped
+    if not line:
+        return None
+
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
         return None
 
-    with open(path, "r") as f:
-        data = f.read()[:-1]
-    if data.startwith("ref:"):
-        return ref_resolve(repo, data[5:])
+    # A slash anywhere but at the end anchors the pattern to its directory,
+    # otherwise it matches a name at any depth.
+    if "/" in line:
+        regex = gitignore_regex(line.lstrip("/"))
     else:
-        return data
+        regex = "(?:.*/)?" + gitignore_regex(line)
+    return (pattern, negated, dir_only, regex)
 
 
-def ref_list(repo, path=None):
+def gitignore_regex(pattern):
     """
-    to collect refs and store them in a dict
+    to translate a wildcard pattern into a regex where wildcards never
+    match "/", except for "**" as a whole path component.
     """
-    if not path:
-        path = repo_dir(repo, "refs")
-    rtn = collections.OrderedDict()
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            rtn[f] = ref_list(repo, can)
+    out = list()
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            j = i
+            while j < n and pattern[j] == "*":
+                j += 1
+            whole = j - i == 2 and (i == 0 or pattern[i - 1] == "/")
+            if whole and j == n:
+                out.append(".*")
+            elif whole and pattern[j] == "/":
+                out.append("(?:.*/)?")
+                j += 1
+            else:
+                out.append("[^/]*")
+            i = j
+            continue
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                out.append("\\[")
+            else:
+                body = pattern[i + 1 : j]
+                negate = body[:1] in ("!", "^")
+                if negate:
+                    body = body[1:]
+                body = body.replace("\\", "\\\\").replace("[", "\\[")
+                out.append("[^/" + body + "]" if negate else "[" + body + "]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
         else:
-            rtn[f] = ref_resolve(repo, can)
-    return rtn
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
 
 
-argsp = argsubparsers.add_parser("show-ref", help="list references")
+def gitignore_compile(rules, flags=0):
+    """
+    to combine the regexes of rules, a list of (position, rule), into
+    one, later rules first. Each alternative is a group named after the
+    rule's position.
+    """
+    if not rules:
+        return None
+    alternatives = list()
+    for i, rule in reversed(rules):
+        alternatives.append("(?P<r{}>{})".format(i, rule[4]))
+    return re.compile("|".join(alternatives), flags)
 
 
-def cmd_showref(args):
+class GitIgnore(object):
     """
-    kickstrter to show ref
+    The ignore rules of a worktree: .gitignore files, read once per
+    directory, then .git/info/exclude and core.excludesFile.
+    Deeper files take precedence over higher ones.
     """
 
+    def __init__(self, repo):
+        self.repo = repo
+        self.icase = repo.conf.getboolean("core", "ignorecase", fallback=False)
+        self.dirs = dict()
+
+        self.base = list()
+        fingerprint = hashlib.sha1(b"icase" if self.icase else b"")
+        default = os.path.join(os.environ.get("XDG_CONFIG_HOME", "~/.config"), "git", "ignore")
+        excludes = repo.conf.get("core", "excludesfile", fallback=None) or gitconfig_global().get(
+            "core", "excludesfile", fallback=default
+        )
+        for source, path in (
+            (".git/info/exclude", repo_path(repo, "info", "exclude")),
+            (excludes, os.path.expanduser(excludes)),
+        ):
+            rules = self.load(source, "", path)
+            if rules:
+                self.base.append(rules)
+                fingerprint.update(repr((source, rules.rules)).encode("utf8", "surrogateescape"))
+        # What the untracked cache is only valid under.
+        self.fingerprint = fingerprint.digest()
+
+    def load(self, source, base, path):
+        try:
+            with open(path, "r", encoding="utf8", errors="surrogateescape") as f:
+                lines = f.readlines()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+        rules = GitIgnoreRules(source, base, lines, self.icase)
+        return rules if rules.rules else None
+
+    def rules(self, directory):
+        """
+        to get the compiled .gitignore of directory, relative to the
+        worktree, or None.
+        """
+        if directory not in self.dirs:
+            source = directory + "/.gitignore" if directory else ".gitignore"
+            path = os.path.join(self.repo.worktree, source)
+            self.dirs[directory] = self.load(source, directory, path)
+        return self.dirs[directory]
+
+    def match(self, path, is_dir):
+        """
+        to find the rule deciding path, relative to the worktree, as
+        (source, lineno, pattern, negated), or None. Its parents are
+        assumed not to be ignored.
+        """
+        directory = path
+        while directory:
+            directory = directory.rpartition("/")[0]
+            rules = self.rules(directory)
+            if rules:
+                rule = rules.match(path[len(directory) + 1 :] if directory else path, is_dir)
+                if rule:
+                    return rule
+        for rules in self.base:
+            rule = rules.match(path, is_dir)
+            if rule:
+                return rule
+        return None
+
+    def ignored(self, path, is_dir):
+        rule = self.match(path, is_dir)
+        return bool(rule) and not rule[3]
+
+    def path_match(self, path, is_dir):
+        """
+        like match, but a path inside an ignored directory is ignored by
+        that directory's rule, as git cannot re-include it.
+        """
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            rule = self.match("/".join(parts[:i]), True)
+            if rule and not rule[3]:
+                return rule
+        return self.match(path, is_dir)
+
+
+argsp = argsubparsers.add_parser("check-ignore", help="Debug gitignore / exclude files")
+argsp.add_argument(
+    "-v", "--verbose", action="store_true", help="show the matching pattern of each path"
+)
+argsp.add_argument(
+    "--no-index", dest="no_index", action="store_true", help="check tracked files too"
+)
+argsp.add_argument("--stdin", action="store_true", help="read the paths from stdin")
+argsp.add_argument("path", nargs="*", help="the paths to check")
+
+
+def cmd_checkignore(args):
+    """
+    kickstarter for check-ignore command.
+    """
     repo = repo_find()
+    ignore = GitIgnore(repo)
+    tracked = set() if args.no_index else {e.name for e in index_read(repo).entries}
+
+    paths = [line.rstrip("\n") for line in sys.stdin] if args.stdin else args.path
+    found = False
+    for path in paths:
+        name = worktree_path(repo, path).replace(os.sep, "/")
+        if not name or name in tracked:
+            continue
+        is_dir = path.endswith("/") or os.path.isdir(path)
+        rule = ignore.path_match(name, is_dir)
+        if not rule or (rule[3] and not args.verbose):
+            continue
+        found = found or not rule[3]
+        if args.verbose:
+            print("{}:{}:{}\t{}".format(rule[0], rule[1], rule[2], path))
+        else:
+            print(path)
+    sys.exit(0 if found else 1)
 
-    refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
 
+argsp = argsubparsers.add_parser("ls-files", help="List all the staged files")
+argsp.add_argument(
+    "-s", "--stage", dest="stage", action="store_true", help="Show mode, sha and stage"
+)
+argsp.add_argument("--verbose", action="store_true", help="Show everything.")
 
-def show_ref(repo, refs, with_hash=True, prefix=""):
+
+def cmd_lsfiles(args):
     """
-    The actual function to show refs
+    kickstarter for ls-files command.
     """
-    for k, v in refs.items():
-        if isinstance(v, str):
-            print(
-                "{}{}{}".format(
-                    v + " " if with_hash else "", prefix + "/" if prefix else "", k
-                )
+    repo = repo_find()
+    index = index_read(repo)
+    if args.verbose:
+        print(
+            "Index file format v{}, containing {} entries.".format(
+                index.version, len(index.entries)
             )
+        )
+
+    for e in index.entries:
+        if args.stage:
+            print("{:06o} {} {}\t{}".format(e.mode, e.sha, e.stage, e.name))
         else:
-            show_ref(
-                repo,
-                v,
-                with_hash=with_hash,
-                prefix="{}{}{}".format(prefix, "/" if prefix else "", k),
-            )
+            print(e.name)
+        if args.verbose:
+            print("  created: {}.{}, modified: {}.{}".format(*e.ctime, *e.mtime))
+            print("  on device: {}, inode: {}".format(e.dev, e.ino))
+            try:
+                user = pwd.getpwuid(e.uid).pw_name
+                group = grp.getgrgid(e.gid).gr_name
+            except KeyError:
+                user, group = e.uid, e.gid
+            print("  user: {} ({})  group: {} ({})".format(user, e.uid, group, e.gid))
+            print("  size: {}, flags: {:#06x}".format(e.size, e.flags))
+
+
+argsp = argsubparsers.add_parser("add", help="Add files contents to the index.")
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=None,
+    help="number of processes hashing files",
+)
+argsp.add_argument("path", nargs="+", help="Files to add")
 
 
-class GitTree(GitCommit):
+def cmd_add(args):
     """
-    This will define the Git Tag class object.
+    kickstarter for add command.
     """
+    repo = repo_find()
+    add(repo, args.path, jobs=args.jobs)
 
-    fmt = b"tag"
 
+def add(repo, paths, jobs=None):
+    """
+    to stage paths; directories are added recursively.
+    Files whose stat data still match their entry are not hashed again.
+    """
+    lock = index_lock(repo)
+    try:
+        add_locked(repo, index_read(repo), lock, paths, jobs)
+    finally:
+        lock.rollback()
 
-argsp = argsubparsers.add_parser("tag", help="List and create tags")
+
+def add_locked(repo, index, lock, paths, jobs=None):
+    """
+    to stage paths into index, under the held index lock.
+    """
+    entries = {e.name: e for e in index.entries}
+    ignore = GitIgnore(repo)
+
+    names = list()
+    removed = set()
+    for path in paths:
+        rel = worktree_path(repo, path)
+        full = os.path.join(repo.worktree, rel)
+        prefix = rel + "/" if rel else ""
+        # Tracked files gone from the worktree are staged as deletions.
+        tracked = [n for n in entries if n == rel or n.startswith(prefix)]
+        gone = {n for n in tracked if not os.path.lexists(os.path.join(repo.worktree, n))}
+        removed.update(gone)
+        if os.path.isdir(full) and not os.path.islink(full):
+            found = set(worktree_files(repo, full, ignore))
+            # Ignored files are only added when already tracked.
+            found.update(n for n in tracked if n not in gone)
+            names.extend(sorted(found))
+        elif os.path.lexists(full):
+            names.append(rel)
+        elif not gone:
+            raise Exception("pathspec '{}' did not match any files".format(path))
+
+    dirty = list()
+    for name in names:
+        st = os.lstat(os.path.join(repo.worktree, name))
+        entry = entries.get(name)
+        if not (entry and index_entry_clean(index, entry, st)):
+            dirty.append((name, st))
+
+    # Large imports go into one pack, synced once, instead of loose files.
+    bulk = GitBulkCheckin(repo) if len(dirty) >= BULK_CHECKIN_MIN else None
+    try:
+        shas = worktree_hash_many(repo, [d[0] for d in dirty], write=True, jobs=jobs)
+        if bulk:
+            bulk.commit()
+    finally:
+        if bulk:
+            bulk.rollback()
+
+    for (name, st), sha in zip(dirty, shas):
+        entry = entries.get(name)
+        if not entry:
+            entry = GitIndexEntry(name=name)
+            entries[name] = entry
+            index.entries.append(entry)
+        # A mode change alone changes the tree too.
+        if (entry.sha, entry.mode) != (sha, index_stat_mode(st)):
+            index.invalidate(name)
+        entry.sha = sha
+        index_entry_stat(entry, st)
+
+    if removed:
+        index.entries = [e for e in index.entries if e.name not in removed]
+        for name in removed:
+            index.invalidate(name)
+
+    if dirty or removed:
+        index_write(repo, index, lock)
+
+
+argsp = argsubparsers.add_parser("rm", help="Remove files from the worktree and the index.")
 argsp.add_argument(
-    "-a", action="store_true", dest="create_tag_object", help="to create a tag"
+    "--cached", action="store_true", help="only remove from the index"
 )
-argsp.add_argument("name", nargs="?", help="tag's name")
-argsp.add_argument("object", default="HEAD", nargs="?", help="The object to point to")
+argsp.add_argument(
+    "-r", dest="recursive", action="store_true", help="remove directories recursively"
+)
+argsp.add_argument("path", nargs="+", help="Files to remove")
 
 
-def cmd_tag(args):
+def cmd_rm(args):
     """
-    kickstarter for tag command.
+    kickstarter for rm command.
     """
     repo = repo_find()
+    rm(repo, args.path, delete=not args.cached, recursive=args.recursive)
 
-    if args.name:
-        tag_create(
-            repo,
-            args.name,
-            args.object,
-            type="object" if args.create_tag_object else "ref",
-        )
+
+def rm(repo, paths, delete=True, recursive=False):
+    """
+    to unstage paths, and delete them from the worktree when delete is set.
+    """
+    lock = index_lock(repo)
+    try:
+        rm_locked(repo, index_read(repo), lock, paths, delete, recursive)
+    finally:
+        lock.rollback()
+
+
+def rm_locked(repo, index, lock, paths, delete=True, recursive=False):
+    """
+    to unstage paths from index, under the held index lock.
+    """
+    remove = set()
+    for path in paths:
+        rel = worktree_path(repo, path)
+        found = [e.name for e in index.entries if e.name == rel]
+        if not found and recursive:
+            prefix = rel + os.sep if rel else ""
+            found = [e.name for e in index.entries if e.name.startswith(prefix)]
+        if not found:
+            raise Exception("pathspec '{}' did not match any files".format(path))
+        remove.update(found)
+
+    index.entries = [e for e in index.entries if e.name not in remove]
+    for name in sorted(remove):
+        index.invalidate(name)
+        if delete:
+            full = os.path.join(repo.worktree, name)
+            if os.path.lexists(full):
+                os.remove(full)
+                dirs_prune(repo.worktree, os.path.dirname(full))
+
+    index_write(repo, index, lock)
+
+
+argsp = argsubparsers.add_parser("status", help="Show the working tree status.")
+
+
+def cmd_status(args):
+    """
+    kickstarter for status command.
+    """
+    repo = repo_find()
+    # Refreshing the index is only a bonus: without the lock, status
+    # still reports, it just does not write.
+    try:
+        lock = index_lock(repo)
+    except Exception:
+        lock = None
+    try:
+        index = index_read(repo)
+        status_branch(repo)
+        status_head_index(repo, index)
+        print()
+        status_index_worktree(repo, index, lock)
+    finally:
+        if lock:
+            lock.rollback()
+
+
+def status_branch(repo):
+    """
+    to print the branch HEAD is on, or the commit it is detached at.
+    """
+    with open(repo_file(repo, "HEAD"), "r") as f:
+        head = f.read().strip()
+    if head.startswith("ref: refs/heads/"):
+        print("On branch {}.".format(head[16:]))
     else:
-        refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        print("HEAD detached at {}".format(head[0:7]))
 
 
-def tag_create(repo, name, ref, create_tag_object=False):
+def status_head_index(repo, index):
     """
-    To call when in need to create a tag object
+    to print the changes staged since HEAD.
     """
-    sha = object_find(repo, ref)
+    print("Changes to be committed:")
+    head = ref_resolve(repo, "HEAD")
+    files = dict()
+    if head:
+        tree = object_read(repo, object_read(repo, head).tree)
+        files = {f[0]: f[2] for f in tree_flatten(repo, tree)[1]}
+
+    for e in index.entries:
+        if e.name not in files:
+            print("  new file:  ", e.name)
+        elif files.pop(e.name) != e.sha:
+            print("  modified:  ", e.name)
+    for name in sorted(files):
+        print("  deleted:   ", name)
+
+
+def status_index_worktree(repo, index, lock=None):
+    """
+    to print the unstaged changes and the untracked files.
+    Only files whose stat data changed are hashed; the ones found clean
+    get their stat data refreshed, when lock is held, so the next status
+    will not hash them.
+    """
+    print("Changes not staged for commit:")
+    dirty = list()
+    for e in index.entries:
+        try:
+            st = os.lstat(os.path.join(repo.worktree, e.name))
+        except FileNotFoundError:
+            print("  deleted:   ", e.name)
+            continue
+        if not index_entry_clean(index, e, st):
+            dirty.append((e, st))
+
+    refreshed = False
+    shas = worktree_hash_many(repo, [d[0].name for d in dirty])
+    for (e, st), sha in zip(dirty, shas):
+        if sha != e.sha or index_stat_mode(st) != e.mode:
+            print("  modified:  ", e.name)
+        else:
+            index_entry_stat(e, st)
+            refreshed = True
 
-    if create_tag_object:
-        tag = GitTag(repo)
+    cache = index.untracked
+    untracked = sorted(untracked_files(repo, index, GitIgnore(repo)))
+    changed = refreshed or index.untracked is not cache or (cache and cache.changed)
+    if changed and lock:
+        index_write(repo, index, lock)
 
-        tag.kvlm = collections.OrderedDict()
-        tag.kvlm[b"object"] = sha.encode()
-        tag.kvlm[b"type"] = b"commit"
-        tag.kvlm[b"tag"] = name.encode()
-        tag.kvlm[b"tagger"] = b"gip <gip@gip.org>"
-        tag.kvlm[None] = b"filler message when creating a tag."
-        tag_sha = object_write(tag)
+    print()
+    print("Untracked files:")
+    for name in untracked:
+        print(" ", name)
+
+
+def untracked_files(repo, index, ignore):
+    """
+    to list the files that are neither tracked nor ignored.
+    With an untracked cache in the index, directories are only listed
+    again when their mtime or ignore rules changed since it recorded
+    them; the others cost a stat of the directory and of its .gitignore.
+    The cache is an extension only gip understands, and git complains
+    about it, so it has its own setting rather than core.untrackedCache:
+    gip.untrackedCache true adds it, false drops it, and keep (the
+    default) uses it only when the index already has one.
+    """
+    tracked = {e.name for e in index.entries}
+    mode = repo.conf.get("gip", "untrackedcache", fallback="keep").strip().lower()
+    if mode in ("false", "no", "off", "0"):
+        # Dropped the next time the index is written.
+        index.untracked = None
+    elif mode in ("true", "yes", "on", "1") and not index.untracked:
+        index.untracked = GitUntrackedCache(ignore.fingerprint)
+
+    cache = index.untracked
+    if not cache:
+        return [n for n in worktree_files(repo, ignore=ignore) if n not in tracked]
+    if cache.excludes != ignore.fingerprint:
+        cache.excludes = ignore.fingerprint
+        cache.dirs.clear()
+        cache.changed = True
+
+    untracked = list()
+    seen = set()
+    stack = [("", False)]
+    while stack:
+        directory, stale = stack.pop()
+        seen.add(directory)
+        full = os.path.join(repo.worktree, directory)
+        try:
+            mtime = os.stat(full).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        try:
+            st = os.stat(os.path.join(full, ".gitignore"))
+            rules = (st.st_mtime_ns, st.st_size)
+        except (FileNotFoundError, NotADirectoryError):
+            rules = (0, 0)
+
+        # Rules are inherited: when a parent's changed, so did these.
+        cached = cache.dirs.get(directory)
+        stale = stale or not cached or cached[1] != rules
+        # Like racily clean entries, a directory changed in the tick the
+        # index was written may have been listed before the change.
+        if stale or cached[0] != mtime or not (index.mtime and mtime < index.mtime):
+            cached = untracked_scan(repo, directory, mtime, rules, tracked, ignore)
+            cache.dirs[directory] = cached
+            cache.changed = True
+
+        prefix = directory + "/" if directory else ""
+        untracked.extend(prefix + f for f in cached[2])
+        stack.extend((prefix + d, stale) for d in reversed(cached[3]))
+
+    for directory in [d for d in cache.dirs if d not in seen]:
+        del cache.dirs[directory]
+        cache.changed = True
+    return untracked
+
+
+def untracked_scan(repo, directory, mtime, rules, tracked, ignore):
+    """
+    to list a directory into an untracked cache entry.
+    """
+    prefix = directory + "/" if directory else ""
+    files, dirs = list(), list()
+    with os.scandir(os.path.join(repo.worktree, directory)) as it:
+        for entry in it:
+            if entry.name == ".git":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if not ignore.ignored(prefix + entry.name, True):
+                    dirs.append(entry.name)
+            elif prefix + entry.name not in tracked and not ignore.ignored(
+                prefix + entry.name, False
+            ):
+                files.append(entry.name)
+    return (mtime, rules, sorted(files), sorted(dirs))
+
+
+argsp = argsubparsers.add_parser("write-tree", help="Create a tree object from the index")
+
+
+def cmd_writetree(args):
+    """
+    kickstarter for write-tree command.
+    """
+    repo = repo_find()
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        print(tree_from_index(repo, index))
+        index_write(repo, index, lock)
+    finally:
+        lock.rollback()
+
+
+def tree_from_index(repo, index):
+    """
+    to write the trees of the index and return the sha of the root one.
+    Directories whose cached-tree node is still valid are not rebuilt:
+    their entries are skipped in one step, so after a change only the
+    trees on the path of the changed files are written again.
+    """
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+    index.entries.sort(key=lambda e: (e.name.encode("utf8"), e.stage))
+    entries = index.entries
+    if any(e.stage for e in entries):
+        raise Exception("Cannot write a tree with unmerged entries")
+
+    def build(start, prefix, node):
+        i = start
+        items = list()
+        seen = set()
+        while i < len(entries) and entries[i].name.startswith(prefix):
+            name = entries[i].name[len(prefix) :]
+            slash = name.find("/")
+            if slash < 0:
+                items.append(
+                    GitTreeLeaf(b"%o" % entries[i].mode, name, entries[i].sha)
+                )
+                i += 1
+                continue
+
+            dirname = name[:slash]
+            sub = prefix + dirname + "/"
+            child = node.subtrees.get(dirname)
+            if child is None:
+                child = node.subtrees[dirname] = GitCacheTree()
+            end = i + child.entry_count
+            # Trust a valid node only if it still spans exactly this directory.
+            if (
+                child.entry_count > 0
+                and entries[end - 1].name.startswith(sub)
+                and (end == len(entries) or not entries[end].name.startswith(sub))
+            ):
+                i = end
+            else:
+                i = build(i, sub, child)
+            items.append(GitTreeLeaf(b"40000", dirname, child.sha))
+            seen.add(dirname)
+
+        for dirname in [d for d in node.subtrees if d not in seen]:
+            del node.subtrees[dirname]
+
+        tree = GitTree()
+        tree.items = items
+        node.sha = object_write(tree, repo)
+        node.entry_count = i - start
+        return i
+
+    root = index.cache_tree
+    if root.entry_count < 0 or root.entry_count != len(entries):
+        build(0, "", root)
+    return root.sha
+
+
+argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
+argsp.add_argument(
+    "-m", metavar="message", dest="message", required=True, help="Message to associate with this commit."
+)
+
+
+def cmd_commit(args):
+    """
+    kickstarter for commit command.
+    """
+    repo = repo_find()
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        tree = tree_from_index(repo, index)
+        index_write(repo, index, lock)
+    finally:
+        lock.rollback()
+
+    parent = ref_resolve(repo, "HEAD")
+    sha = commit_create(repo, tree, parent, gitconfig_user(repo), datetime.now(), args.message)
+
+    # HEAD's branch, or HEAD itself when detached, must not have moved.
+    tx = GitRefTransaction(repo)
+    tx.update("HEAD", sha, parent or ZERO_SHA)
+    tx.commit()
+
+
+def gitconfig_global():
+    """
+    to read the user's config, the XDG one and then ~/.gitconfig.
+    """
+    conf = configparser.ConfigParser()
+    xdg = os.environ.get("XDG_CONFIG_HOME", "~/.config")
+    conf.read(
+        [
+            os.path.expanduser(os.path.join(xdg, "git", "config")),
+            os.path.expanduser("~/.gitconfig"),
+        ]
+    )
+    return conf
+
+
+def gitconfig_user(repo):
+    """
+    to find "name <email>" in the repository config, then ~/.gitconfig.
+    """
+    conf = gitconfig_global()
+    name = repo.conf.get("user", "name", fallback=None) or conf.get(
+        "user", "name", fallback="gip"
+    )
+    email = repo.conf.get("user", "email", fallback=None) or conf.get(
+        "user", "email", fallback="gip@gip.org"
+    )
+    return "{} <{}>".format(name, email)
+
+
+def identity_stamp(ident, timestamp):
+    """
+    to format "name <email> seconds +hhmm" for author, committer and tagger lines.
+    """
+    timestamp = timestamp.astimezone()
+    offset = int(timestamp.utcoffset().total_seconds()) // 60
+    tz = "{}{:02}{:02}".format("+" if offset >= 0 else "-", abs(offset) // 60, abs(offset) % 60)
+    return "{} {} {}".format(ident, int(timestamp.timestamp()), tz).encode("utf8")
+
+
+def commit_create(repo, tree, parent, author, timestamp, message):
+    """
+    to write a commit object and return its sha.
+    """
+    commit = GitCommit()
+    commit.kvlm = collections.OrderedDict()
+    commit.kvlm[b"tree"] = tree.encode("ascii")
+    if parent:
+        commit.kvlm[b"parent"] = parent.encode("ascii")
+
+    stamp = identity_stamp(author, timestamp)
+    commit.kvlm[b"author"] = stamp
+    commit.kvlm[b"committer"] = stamp
+
+    message = message.strip() + "\n"
+    commit.kvlm[None] = message.encode("utf8")
+    return object_write(commit, repo)
+
+
+argsp = argsubparsers.add_parser(
+    "rev-list", help="List, or count, the commits reachable from revisions"
+)
+argsp.add_argument(
+    "--count", action="store_true", help="print only how many there are"
+)
+argsp.add_argument(
+    "--objects",
+    action="store_true",
+    help="list every reachable object, not only commits",
+)
+argsp.add_argument(
+    "revisions",
+    nargs="+",
+    help="commits to start at; ^commit and a..b leave out what a commit reaches",
+)
+
+
+def cmd_revlist(args):
+    """
+    kickstarter for rev-list command.
+    """
+    repo = repo_find()
+    include, exclude = list(), list()
+    for rev in args.revisions:
+        if ".." in rev:
+            a, b = rev.split("..", 1)
+            exclude.append(object_find(repo, a or "HEAD"))
+            include.append(object_find(repo, b or "HEAD"))
+        elif rev.startswith("^"):
+            exclude.append(object_find(repo, rev[1:]))
+        else:
+            include.append(object_find(repo, rev))
+
+    if args.count:
+        print(rev_list_count(repo, include, exclude, args.objects))
+        return
+    try:
+        for sha in rev_list(repo, include, exclude, args.objects):
+            print(sha)
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
-        ref_create(repo, "tags/" + name, tag_sha)
 
+def rev_list(repo, include, exclude, objects=False):
+    """
+    to yield the commits reachable from include but not from exclude,
+    newest first; with objects, every such object instead, in pack order
+    when the reachability bitmap is used.
+    """
+    bitmap = repo_bitmap(repo)
+    if objects and bitmap:
+        bits, extra = rev_list_bitmap(repo, bitmap, include, exclude, objects)
+        for pos in bitset_positions(bits):
+            yield bitmap.sha(pos)
+        yield from extra
+    elif objects:
+        hidden = {o[0] for o in object_walk(repo, exclude)}
+        for sha, _, _, _ in object_walk(repo, include):
+            if sha not in hidden:
+                yield sha
     else:
-        ref_create(repo, "tags/" + name, sha)
+        include = [c for c in (commit_peel(repo, sha) for sha in include) if c]
+        exclude = [c for c in (commit_peel(repo, sha) for sha in exclude) if c]
+        hidden = set(rev_walk(repo, exclude))
+        for sha in rev_walk(repo, include):
+            if sha not in hidden:
+                yield sha
+
+
+def rev_list_count(repo, include, exclude, objects=False):
+    """
+    to count what rev_list would yield; with a reachability bitmap this
+    is a popcount, not a listing.
+    """
+    bitmap = repo_bitmap(repo)
+    if not bitmap:
+        return sum(1 for _ in rev_list(repo, include, exclude, objects))
+    bits, extra = rev_list_bitmap(repo, bitmap, include, exclude, objects)
+    return bits.bit_count() + len(extra)
+
+
+def rev_list_bitmap(repo, bitmap, include, exclude, objects=False):
+    """
+    to find, with the reachability bitmap, what include reaches and
+    exclude does not, as a bitset over the pack plus the objects outside
+    of it. Without objects, only commits are kept.
+    """
+
+    def reach(shas):
+        return bitmap_reach(repo, shas, bitmap.position, bitmap.bitmap, objects)
+
+    bits, extra = reach(include)
+    if exclude:
+        hidden, hidden_extra = reach(exclude)
+        bits &= ~hidden
+        extra = {sha: fmt for sha, fmt in extra.items() if sha not in hidden_extra}
+    if not objects:
+        bits &= bitmap.types[b"commit"]
+        extra = {sha: fmt for sha, fmt in extra.items() if fmt == b"commit"}
+    return bits, extra
 
 
-def ref_create(repo, ref_name, sha):
+argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers")
+argsp.add_argument(
+    "--type",
+    metavar="type",
+    dest="type",
+    choices=["blob", "commit", "tag", "tree"],
+    default=None,
+    help="Specify the expected type",
+)
+argsp.add_argument("name", help="The name to parse")
+
+
+def cmd_revparse(args):
     """
-    To create a ref.
+    kickstarter for rev-parse command.
     """
-    with open(repo_file(repo, "refs/" + ref_name), "w") as f:
-        f.write(sha + "\n")
+    fmt = args.type.encode() if args.type else None
+    repo = repo_find()
+    print(object_find(repo, args.name, fmt, follow=True))